@@ -20,6 +20,7 @@ class DatasetConfig:
     direct_urls: list[str] = field(default_factory=list)
     resource_filter: Callable[[dict], bool] | None = None
     notes: str = ""
+    snapshot: bool = False  # full-extract registry: keep vintages for diffing (etl.snapshot)
 
 
 # ---------------------------------------------------------------------------
@@ -56,13 +57,13 @@ def _finess_filter(resource: dict) -> bool:
 
 
 def _insee_cog_filter(resource: dict) -> bool:
-    """Keep commune, departement, and region CSV files from INSEE COG."""
+    """Keep commune, departement, region and commune-movement CSV files from INSEE COG."""
     title = (resource.get("title") or "").lower()
     url = (resource.get("url") or "").lower()
     fmt = (resource.get("format") or "").lower()
     return fmt == "csv" and any(
         kw in (title + url)
-        for kw in ["v_commune", "v_departement", "v_region", "v_pays"]
+        for kw in ["v_commune", "v_departement", "v_region", "v_pays", "v_mvt_commune"]
     )
 
 
@@ -97,6 +98,7 @@ DATASETS: dict[str, DatasetConfig] = {
         file_format="txt",
         resource_filter=_rpps_filter,
         notes="Main file ~800MB. Pipe-delimited.",
+        snapshot=True,
     ),
     "open_medic": DatasetConfig(
         name="open_medic",
@@ -119,6 +121,7 @@ DATASETS: dict[str, DatasetConfig] = {
         file_format="csv",
         resource_filter=_finess_filter,
         notes="Includes geolocated and standard establishment files.",
+        snapshot=True,
     ),
     "insee_cog": DatasetConfig(
         name="insee_cog",
@@ -10,26 +10,28 @@ Usage:
 from __future__ import annotations
 
 import argparse
-import asyncio
 import json
 from datetime import datetime, timezone
 from pathlib import Path
+from typing import TYPE_CHECKING
 from urllib.parse import unquote, urlparse
 
-import httpx
-from tenacity import retry, stop_after_attempt, wait_exponential
-from tqdm import tqdm
-
-from etl.config import BDPM_FILES, DATASETS, DatasetConfig
+from etl.config import DATASETS, DatasetConfig
 from etl.utils import (
-    get_config,
     get_raw_dir,
+    get_settings,
     make_http_client,
     sanitize_filename,
     setup_logging,
     sha256_file,
 )
 
+if TYPE_CHECKING:
+    import httpx
+
+# asyncio, tenacity, tqdm and etl.snapshot (duckdb) are imported where they are
+# used: `--list` and other metadata-only commands must not pay for them.
+
 logger = setup_logging("etl.download")
 
 
@@ -60,7 +62,7 @@ async def discover_resources(
     resource_filter: callable | None = None,
 ) -> list[dict]:
     """Fetch resource list from data.gouv.fr API and optionally filter."""
-    api_base = get_config("DATAGOUV_API_BASE", "https://www.data.gouv.fr/api/1")
+    api_base = get_settings().datagouv_api_base
     url = f"{api_base}/datasets/{dataset_id}/"
     logger.info("Discovering resources for dataset: %s", dataset_id)
 
@@ -82,7 +84,6 @@ async def discover_resources(
 # Streaming file download
 # ---------------------------------------------------------------------------
 
-@retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=5, min=5, max=60))
 async def stream_download(
     client: httpx.AsyncClient,
     url: str,
@@ -93,6 +94,24 @@ async def stream_download(
 
     Returns file metadata dict with size and hash.
     """
+    from tenacity import AsyncRetrying, stop_after_attempt, wait_exponential
+
+    async for attempt in AsyncRetrying(
+        stop=stop_after_attempt(get_settings().download_max_retries),
+        wait=wait_exponential(multiplier=5, min=5, max=60),
+    ):
+        with attempt:
+            return await _stream_download_once(client, url, dest, desc)
+
+
+async def _stream_download_once(
+    client: httpx.AsyncClient,
+    url: str,
+    dest: Path,
+    desc: str | None,
+) -> dict:
+    from tqdm import tqdm
+
     part_file = dest.with_suffix(dest.suffix + ".part")
     dest.parent.mkdir(parents=True, exist_ok=True)
 
@@ -136,8 +155,16 @@ async def download_dataset(config: DatasetConfig) -> dict:
     dataset_dir = raw_dir / config.name
     dataset_dir.mkdir(parents=True, exist_ok=True)
 
+    if config.snapshot:
+        from etl.snapshot import archive_vintage
+
+        # Keep the previous extract so etl.snapshot can diff against it
+        archive_vintage(dataset_dir)
+
     metadata = _load_metadata(dataset_dir)
-    downloaded_files = metadata.get("files", {})
+    previous_files = metadata.get("files", {})
+    # Only what this run finds upstream: extracts named by date supersede each other
+    downloaded_files: dict[str, dict] = {}
 
     async with make_http_client() as client:
         if config.source_type == "datagouv_api" and config.dataset_id:
@@ -151,8 +178,9 @@ async def download_dataset(config: DatasetConfig) -> dict:
                 filename = _derive_filename(url, title)
                 dest = dataset_dir / filename
 
-                if _should_skip(dest, downloaded_files.get(filename)):
+                if _should_skip(dest, previous_files.get(filename)):
                     logger.info("Skipping %s (already downloaded)", filename)
+                    downloaded_files[filename] = previous_files[filename]
                     continue
 
                 logger.info("Downloading %s from %s", filename, url[:80])
@@ -165,14 +193,19 @@ async def download_dataset(config: DatasetConfig) -> dict:
                 filename = _derive_filename(url)
                 dest = dataset_dir / filename
 
-                if _should_skip(dest, downloaded_files.get(filename)):
+                if _should_skip(dest, previous_files.get(filename)):
                     logger.info("Skipping %s (already downloaded)", filename)
+                    downloaded_files[filename] = previous_files[filename]
                     continue
 
                 logger.info("Downloading %s from %s", filename, url[:80])
                 file_meta = await stream_download(client, url, dest, desc=filename)
                 downloaded_files[filename] = file_meta
 
+    if config.snapshot:
+        _drop_superseded(dataset_dir, previous_files, downloaded_files)
+    else:
+        downloaded_files = {**previous_files, **downloaded_files}
     metadata["files"] = downloaded_files
     metadata["encoding"] = config.encoding
     metadata["separator"] = config.separator
@@ -181,6 +214,17 @@ async def download_dataset(config: DatasetConfig) -> dict:
     return metadata
 
 
+def _drop_superseded(dataset_dir: Path, previous: dict, current: dict) -> None:
+    """Delete files of the previous snapshot extract that this download replaced.
+
+    They were archived as a vintage first, so the live directory (and its
+    metadata) only ever holds one extract.
+    """
+    for filename in previous.keys() - current.keys():
+        (dataset_dir / filename).unlink(missing_ok=True)
+        logger.info("Removed superseded %s (archived under _vintages/)", filename)
+
+
 def _derive_filename(url: str, title: str = "") -> str:
     """Extract a clean filename from a URL or resource title."""
     parsed = urlparse(url)
@@ -305,6 +349,8 @@ def main() -> None:
             print(f"  {name:25s} — {cfg.description}")
         return
 
+    import asyncio
+
     results = asyncio.run(download_all(args.datasets))
 
     print("\n" + "=" * 60)
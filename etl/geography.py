@@ -0,0 +1,252 @@
+"""
+Commune-history-aware geography resolver.
+
+Sources carry commune codes from different COG vintages (RPPS, FINESS,
+Transparence Santé) and communes merge every year, so a naive join to
+``dim_geography`` drops rows. The resolver follows the INSEE movement history
+(``v_mvt_commune``) once and precomputes a flat array indexed by encoded
+commune code, so millions of fact rows are remapped to ``geo_key`` with a
+single vectorized ``take`` (or one DuckDB join on ``geo_commune_map``).
+
+``geo_key`` convention: the current INSEE commune code encoded as an integer
+(``encode_commune_code``), stable across COG vintages.
+"""
+
+from __future__ import annotations
+
+from pathlib import Path
+
+import duckdb
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
+
+from etl.utils import arrow_table, get_raw_dir, setup_logging
+
+logger = setup_logging("etl.geography")
+
+# Commune types that are rows of dim_geography (COMD/COMA resolve to their parent)
+CURRENT_TYPES = ("COM", "ARM")
+
+# Encoded codes: 00000-99999 for numeric codes, 2Axxx -> 100xxx, 2Bxxx -> 101xxx
+LOOKUP_SIZE = 102_000
+
+# Maximum number of movements followed for one code (guards against cycles)
+_MAX_HOPS = 32
+
+# Pre-2016 regions -> regions since the 1 January 2016 reform
+PRE_2016_REGIONS: dict[str, str] = {
+    "21": "44",  # Champagne-Ardenne -> Grand Est
+    "22": "32",  # Picardie -> Hauts-de-France
+    "23": "28",  # Haute-Normandie -> Normandie
+    "25": "28",  # Basse-Normandie -> Normandie
+    "26": "27",  # Bourgogne -> Bourgogne-Franche-Comté
+    "31": "32",  # Nord-Pas-de-Calais -> Hauts-de-France
+    "41": "44",  # Lorraine -> Grand Est
+    "42": "44",  # Alsace -> Grand Est
+    "43": "27",  # Franche-Comté -> Bourgogne-Franche-Comté
+    "54": "75",  # Poitou-Charentes -> Nouvelle-Aquitaine
+    "72": "75",  # Aquitaine -> Nouvelle-Aquitaine
+    "73": "76",  # Midi-Pyrénées -> Occitanie
+    "74": "75",  # Limousin -> Nouvelle-Aquitaine
+    "82": "84",  # Rhône-Alpes -> Auvergne-Rhône-Alpes
+    "83": "84",  # Auvergne -> Auvergne-Rhône-Alpes
+    "91": "76",  # Languedoc-Roussillon -> Occitanie
+}
+
+
+# ---------------------------------------------------------------------------
+# Code encoding
+# ---------------------------------------------------------------------------
+
+def encode_commune_code(code: str) -> int | None:
+    """Encode a 5-char INSEE commune code as an integer (None if malformed)."""
+    if len(code) != 5:
+        return None
+    if code[:2] in ("2A", "2B") and code[2:].isdigit():
+        return (100_000 if code[1] == "A" else 101_000) + int(code[2:])
+    return int(code) if code.isdigit() else None
+
+
+def encode_commune_codes(codes: pa.Array) -> pa.Array:
+    """Vectorized ``encode_commune_code``: malformed or null codes become null."""
+    codes = pc.utf8_trim_whitespace(pc.cast(codes, pa.string()))
+    valid = pc.match_substring_regex(codes, r"^([0-9]{5}|2[AB][0-9]{3})$")
+    digits = pc.replace_substring_regex(codes, r"^2A", "100")
+    digits = pc.replace_substring_regex(digits, r"^2B", "101")
+    digits = pc.if_else(valid, digits, pa.scalar(None, pa.string()))
+    return pc.cast(digits, pa.int32())
+
+
+# ---------------------------------------------------------------------------
+# COG files
+# ---------------------------------------------------------------------------
+
+def _latest(cog_dir: Path, pattern: str) -> Path:
+    files = sorted(cog_dir.glob(pattern))
+    if not files:
+        raise FileNotFoundError(f"No {pattern} in {cog_dir}")
+    return files[-1]
+
+
+def _read_cog(path: Path) -> pa.Table:
+    """Read a COG CSV with every column as string (codes keep leading zeros)."""
+    with open(path, encoding="utf-8-sig") as f:
+        header = f.readline().strip().split(",")
+    return pacsv.read_csv(
+        path,
+        convert_options=pacsv.ConvertOptions(
+            column_types={name.strip('"'): pa.string() for name in header},
+            strings_can_be_null=True,
+        ),
+    )
+
+
+# ---------------------------------------------------------------------------
+# Resolver
+# ---------------------------------------------------------------------------
+
+class GeographyResolver:
+    """Maps commune codes of any COG vintage to the current commune and ``geo_key``."""
+
+    def __init__(self, current_of: dict[str, str], current_codes: set[str]) -> None:
+        self.current_of = current_of
+        self.current_codes = current_codes
+        lookup: list[int | None] = [None] * LOOKUP_SIZE
+        for old, new in current_of.items():
+            idx = encode_commune_code(old)
+            if idx is not None:
+                lookup[idx] = encode_commune_code(new)
+        self.lookup = pa.array(lookup, type=pa.int32())
+
+    @classmethod
+    def from_cog(cls, cog_dir: Path | None = None) -> GeographyResolver:
+        """Build the resolver from downloaded ``v_commune`` and ``v_mvt_commune`` files."""
+        cog_dir = cog_dir or get_raw_dir() / "insee_cog"
+        communes = _read_cog(_latest(cog_dir, "v_commune_[0-9]*.csv")).to_pylist()
+        movements = _read_cog(_latest(cog_dir, "v_mvt_commune_[0-9]*.csv")).to_pylist()
+
+        current = {c["COM"] for c in communes if c["TYPECOM"] in CURRENT_TYPES}
+        parent = {
+            c["COM"]: c["COMPARENT"]
+            for c in communes
+            if c["TYPECOM"] not in CURRENT_TYPES and c.get("COMPARENT")
+        }
+        successor = _successors(movements)
+
+        known = current | parent.keys() | successor.keys()
+        known |= {m["COM_AV"] for m in movements} | {m["COM_AP"] for m in movements}
+        current_of: dict[str, str] = {}
+        for code in known:
+            resolved = _follow(code, current, successor, parent)
+            if resolved is not None:
+                current_of[code] = resolved
+        logger.info(
+            "Geography resolver: %d current communes, %d historical codes remapped",
+            len(current), sum(1 for k, v in current_of.items() if k != v),
+        )
+        return cls(current_of, current)
+
+    def resolve(self, code: str) -> str | None:
+        """Return the current commune code for ``code`` (None if unknown)."""
+        return self.current_of.get(code.strip())
+
+    def geo_keys(self, codes: pa.Array) -> pa.Array:
+        """Remap an array of commune codes (any vintage) to ``geo_key`` in one take."""
+        return pc.take(self.lookup, encode_commune_codes(codes))
+
+    def to_table(self) -> pa.Table:
+        """Flat old-code -> current-code/geo_key table, for SQL joins."""
+        old = sorted(self.current_of)
+        new = [self.current_of[c] for c in old]
+        return pa.table({
+            "code_commune": pa.array(old, pa.string()),
+            "code_commune_insee": pa.array(new, pa.string()),
+            "geo_key": pa.array([encode_commune_code(c) for c in new], pa.int32()),
+        })
+
+    def register(self, conn: duckdb.DuckDBPyConnection, name: str = "geo_commune_map") -> None:
+        """Expose ``to_table()`` to DuckDB as a view so loaders can join on it."""
+        conn.register(name, self.to_table())
+
+
+def _successors(movements: list[dict]) -> dict[str, str]:
+    """Return, for each commune code that no longer exists as such, its successor.
+
+    Only the latest movement of a code decides: if the code is still among the
+    resulting communes (rétablissement, name change) it survives; otherwise it
+    maps to the resulting commune (the smallest code if it was split).
+    """
+    latest: dict[str, tuple[str, set[str]]] = {}
+    for m in movements:
+        if m["TYPECOM_AV"] != "COM" or m["TYPECOM_AP"] != "COM":
+            continue
+        old, date = m["COM_AV"], m["DATE_EFF"]
+        seen = latest.get(old)
+        if seen is None or date > seen[0]:
+            latest[old] = (date, {m["COM_AP"]})
+        elif date == seen[0]:
+            seen[1].add(m["COM_AP"])
+    return {old: min(targets) for old, (_, targets) in latest.items() if old not in targets}
+
+
+def _follow(
+    code: str,
+    current: set[str],
+    successor: dict[str, str],
+    parent: dict[str, str],
+) -> str | None:
+    for _ in range(_MAX_HOPS):
+        if code in current:
+            return code
+        nxt = successor.get(code) or parent.get(code)
+        if nxt is None:
+            return None
+        code = nxt
+    logger.warning("Commune movement cycle around %s", code)
+    return None
+
+
+# ---------------------------------------------------------------------------
+# Regions and dim_geography
+# ---------------------------------------------------------------------------
+
+def resolve_region_codes(codes: pa.Array) -> pa.Array:
+    """Map pre-2016 region codes to current ones; current codes pass through."""
+    codes = pc.utf8_trim_whitespace(pc.cast(codes, pa.string()))
+    old = pa.array(list(PRE_2016_REGIONS), pa.string())
+    new = pa.array(list(PRE_2016_REGIONS.values()), pa.string())
+    mapped = pc.take(new, pc.index_in(codes, value_set=old))
+    return pc.coalesce(mapped, codes)
+
+
+def dim_geography_table(cog_dir: Path | None = None) -> pa.Table:
+    """Build ``dim_geography`` rows (current communes) from the COG files."""
+    cog_dir = cog_dir or get_raw_dir() / "insee_cog"
+    conn = duckdb.connect(":memory:")
+    try:
+        conn.register("communes", _read_cog(_latest(cog_dir, "v_commune_[0-9]*.csv")))
+        conn.register("departements", _read_cog(_latest(cog_dir, "v_departement_*.csv")))
+        conn.register("regions", _read_cog(_latest(cog_dir, "v_region_*.csv")))
+        table = arrow_table(conn.execute("""
+            SELECT
+                c.COM AS code_commune_insee,
+                c.LIBELLE AS nom_commune,
+                c.TYPECOM AS type_commune,
+                coalesce(c.DEP, p.DEP) AS code_departement,
+                d.LIBELLE AS nom_departement,
+                coalesce(c.REG, p.REG) AS code_region,
+                r.LIBELLE AS nom_region,
+                NULL::INTEGER AS population
+            FROM communes c
+            -- arrondissements municipaux carry no DEP/REG: take the parent's
+            LEFT JOIN communes p ON p.COM = c.COMPARENT AND p.TYPECOM = 'COM'
+            LEFT JOIN departements d ON d.DEP = coalesce(c.DEP, p.DEP)
+            LEFT JOIN regions r ON r.REG = coalesce(c.REG, p.REG)
+            WHERE list_contains(?, c.TYPECOM)
+            ORDER BY c.COM
+        """, [list(CURRENT_TYPES)]))
+    finally:
+        conn.close()
+    geo_key = encode_commune_codes(table.column("code_commune_insee"))
+    return table.add_column(0, "geo_key", geo_key)
@@ -0,0 +1,61 @@
+"""Load ledger — records every write to the DuckDB warehouse.
+
+Each load appends one row to ``etl_load_ledger``. The highest ``load_id`` is the
+warehouse version: readers (e.g. the query service cache) compare it to detect
+that the star schema changed underneath them.
+"""
+
+from __future__ import annotations
+
+from datetime import datetime, timezone
+
+import duckdb
+
+LOAD_LEDGER_TABLE = "etl_load_ledger"
+
+_LEDGER_DDL = f"""
+CREATE SEQUENCE IF NOT EXISTS {LOAD_LEDGER_TABLE}_seq START 1;
+CREATE TABLE IF NOT EXISTS {LOAD_LEDGER_TABLE} (
+    load_id         BIGINT PRIMARY KEY DEFAULT nextval('{LOAD_LEDGER_TABLE}_seq'),
+    dataset         VARCHAR(50) NOT NULL,
+    target_table    VARCHAR(100) NOT NULL,
+    rows_affected   BIGINT,
+    source_vintage  VARCHAR(100),            -- e.g. _metadata.json last_updated
+    loaded_at       TIMESTAMPTZ NOT NULL
+);
+"""
+
+
+def ensure_ledger(conn: duckdb.DuckDBPyConnection) -> None:
+    """Create the ledger table if it does not exist yet."""
+    conn.execute(_LEDGER_DDL)
+
+
+def record_load(
+    conn: duckdb.DuckDBPyConnection,
+    dataset: str,
+    target_table: str,
+    rows_affected: int | None = None,
+    source_vintage: str | None = None,
+) -> int:
+    """Append a ledger entry and return its ``load_id`` (the new warehouse version)."""
+    ensure_ledger(conn)
+    row = conn.execute(
+        f"INSERT INTO {LOAD_LEDGER_TABLE} "
+        "(dataset, target_table, rows_affected, source_vintage, loaded_at) "
+        "VALUES (?, ?, ?, ?, ?) RETURNING load_id",
+        [dataset, target_table, rows_affected, source_vintage, datetime.now(timezone.utc)],
+    ).fetchone()
+    return int(row[0])
+
+
+def ledger_version(conn: duckdb.DuckDBPyConnection) -> int:
+    """Return the current warehouse version (0 if nothing was ever loaded)."""
+    exists = conn.execute(
+        "SELECT count(*) FROM information_schema.tables WHERE table_name = ?",
+        [LOAD_LEDGER_TABLE],
+    ).fetchone()[0]
+    if not exists:
+        return 0
+    row = conn.execute(f"SELECT coalesce(max(load_id), 0) FROM {LOAD_LEDGER_TABLE}").fetchone()
+    return int(row[0])
@@ -0,0 +1,459 @@
+"""
+HCP engagement profile store (RPPS × payments × prescribing context).
+
+Profiles are precomputed into three warehouse tables so that profiling one
+HCP never scans ``fact_pharma_payments``:
+
+- ``hcp_profile``             one row per ``numero_rpps`` with payment totals
+- ``hcp_profile_payments``    totals per RPPS × lab × category × year
+- ``hcp_prescribing_context`` Open Medic totals per region × specialty × year
+
+A full build writes the tables sorted by ``numero_rpps``. ``refresh_profiles``
+reads the load ledger and recomputes only the RPPS touched by ``dim_hcp`` or
+``fact_pharma_payments`` loads since the last build. Payment loaders declare
+those RPPS — both the rows they remove and the rows they write — with
+``record_payment_rpps``; a payments load that declares none triggers a full
+build. ``ProfileStore`` keeps the sorted tables in memory and answers lookups
+by binary search.
+
+Open Medic has no prescriber geography since 2024 (PSP_DEP was dropped for
+BEN_REG), so the prescribing context is the *beneficiaries'* region × the
+prescriber specialty, matched to the HCP's region of practice. It describes
+the market an HCP works in, not the HCP's own prescriptions.
+
+Usage:
+    python -m etl.profiles              # Incremental refresh
+    python -m etl.profiles --full       # Full rebuild
+"""
+
+from __future__ import annotations
+
+import argparse
+from bisect import bisect_left, bisect_right
+from collections.abc import Iterable
+
+import duckdb
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from etl.geography import resolve_region_codes
+from etl.ledger import LOAD_LEDGER_TABLE, ensure_ledger, record_load
+from etl.snapshot import SNAPSHOT_SPECS, history_table
+from etl.utils import arrow_table, get_settings, setup_logging
+
+logger = setup_logging("etl.profiles")
+
+PROFILE_DATASET = "hcp_profile"
+
+# RPPS savoir-faire (ANS nomenclature TRE_R38) -> Open Medic prescriber specialty
+# (PSP_SPE, CNAM numeric codes, see notebook 03). Unlisted specialties have no
+# Open Medic counterpart and get no prescribing context.
+SAVOIR_FAIRE_PSP_SPE: dict[str, str] = {
+    "SM01": "37",  # Anatomie et cytologie pathologiques
+    "SM02": "2",   # Anesthésie-réanimation
+    "SM04": "3",   # Cardiologie et maladies vasculaires
+    "SM05": "4",   # Chirurgie générale
+    "SM15": "5",   # Dermatologie et vénéréologie
+    "SM16": "42",  # Endocrinologie et métabolisme
+    "SM20": "7",   # Gynécologie-obstétrique
+    "SM24": "8",   # Gastro-entérologie et hépatologie
+    "SM26": "1",   # Qualifié en médecine générale
+    "SM27": "9",   # Médecine interne
+    "SM29": "31",  # Médecine physique et réadaptation
+    "SM30": "35",  # Néphrologie
+    "SM32": "32",  # Neurologie
+    "SM38": "15",  # Ophtalmologie
+    "SM39": "11",  # Oto-rhino-laryngologie
+    "SM40": "12",  # Pédiatrie
+    "SM41": "13",  # Pneumologie
+    "SM42": "17",  # Psychiatrie
+    "SM44": "6",   # Radio-diagnostic et imagerie médicale
+    "SM48": "14",  # Rhumatologie
+    "SM50": "18",  # Stomatologie
+    "SM53": "1",   # Spécialiste en médecine générale
+    "SM54": "1",   # Médecine générale
+}
+
+# Open Medic reports every salaried (hospital) prescriber under one code
+PSP_SPE_SALARIES = "90"
+
+_PROFILE_DDL = """
+CREATE TABLE IF NOT EXISTS hcp_profile (
+    numero_rpps             VARCHAR(11) PRIMARY KEY,
+    hcp_key                 INTEGER,
+    nom_exercice            VARCHAR(100),
+    prenom_exercice         VARCHAR(100),
+    code_savoir_faire       VARCHAR(10),
+    libelle_savoir_faire    VARCHAR(200),
+    psp_spe                 VARCHAR(3),            -- Open Medic prescriber specialty
+    code_departement        VARCHAR(3),
+    code_region             VARCHAR(2),
+    montant_ttc_total       DECIMAL(15,2),
+    nb_declarations         BIGINT,
+    nb_labs                 INTEGER,
+    first_annee             SMALLINT,
+    last_annee              SMALLINT
+);
+CREATE TABLE IF NOT EXISTS hcp_profile_payments (
+    numero_rpps             VARCHAR(11) NOT NULL,
+    lab_key                 INTEGER,
+    categorie               VARCHAR(100),
+    annee                   SMALLINT,
+    montant_ttc             DECIMAL(15,2),
+    nb_declarations         BIGINT
+);
+CREATE TABLE IF NOT EXISTS hcp_prescribing_context (
+    code_region             VARCHAR(2),            -- Open Medic BEN_REG, current codes
+    hcp_profession_code     VARCHAR(10),           -- Open Medic PSP_SPE
+    annee                   SMALLINT,
+    nb_boites               BIGINT,
+    montant_rembourse       DECIMAL(15,2)
+);
+CREATE TABLE IF NOT EXISTS hcp_profile_pending_rpps (
+    load_id                 BIGINT NOT NULL,       -- fact_pharma_payments load (ledger)
+    numero_rpps             VARCHAR(11) NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_hcp_profile_pay_rpps ON hcp_profile_payments(numero_rpps);
+"""
+
+
+def ensure_profile_tables(conn: duckdb.DuckDBPyConnection) -> None:
+    conn.execute(_PROFILE_DDL)
+
+
+def record_payment_rpps(
+    conn: duckdb.DuckDBPyConnection, load_id: int, rpps: Iterable[str]
+) -> None:
+    """Declare the RPPS whose payments a ``fact_pharma_payments`` load changed.
+
+    Call it in the load's transaction with the RPPS of the rows removed or
+    corrected as well as those inserted, so the next ``refresh_profiles``
+    recomputes exactly these profiles.
+    """
+    ensure_profile_tables(conn)
+    conn.register("_load_rpps", pa.table({"numero_rpps": pa.array(list(rpps), pa.string())}))
+    try:
+        conn.execute(
+            "INSERT INTO hcp_profile_pending_rpps SELECT DISTINCT ?, numero_rpps "
+            "FROM _load_rpps WHERE numero_rpps IS NOT NULL",
+            [load_id],
+        )
+    finally:
+        conn.unregister("_load_rpps")
+
+
+# ---------------------------------------------------------------------------
+# Build
+# ---------------------------------------------------------------------------
+
+def _rpps_filter(column: str, dirty: bool) -> str:
+    return f"AND {column} IN (SELECT numero_rpps FROM _dirty_rpps)" if dirty else ""
+
+
+def _psp_spe_map() -> pa.Table:
+    return pa.table({
+        "code_savoir_faire": pa.array(list(SAVOIR_FAIRE_PSP_SPE), pa.string()),
+        "psp_spe": pa.array(list(SAVOIR_FAIRE_PSP_SPE.values()), pa.string()),
+    })
+
+
+def _insert_profiles(conn: duckdb.DuckDBPyConnection, dirty: bool) -> None:
+    """Aggregate payments (all RPPS, or those in ``_dirty_rpps``) into the profile tables."""
+    conn.register("_psp_spe_map", _psp_spe_map())
+    conn.execute(f"""
+        INSERT INTO hcp_profile_payments
+        SELECT numero_rpps, lab_key, categorie, annee,
+               sum(montant_ttc), count(*)
+        FROM fact_pharma_payments
+        WHERE numero_rpps IS NOT NULL {_rpps_filter("numero_rpps", dirty)}
+        GROUP BY numero_rpps, lab_key, categorie, annee
+        ORDER BY numero_rpps, annee, lab_key, categorie
+    """)
+    conn.execute(f"""
+        INSERT INTO hcp_profile
+        SELECT p.numero_rpps,
+               h.hcp_key,
+               h.nom_exercice,
+               h.prenom_exercice,
+               h.code_savoir_faire,
+               h.libelle_savoir_faire,
+               CASE WHEN h.code_mode_exercice = 'S' THEN '{PSP_SPE_SALARIES}'
+                    ELSE s.psp_spe END,
+               h.code_departement_exercice,
+               r.code_region,
+               p.montant_ttc_total,
+               p.nb_declarations,
+               p.nb_labs,
+               p.first_annee,
+               p.last_annee
+        FROM (
+            SELECT numero_rpps,
+                   sum(montant_ttc)         AS montant_ttc_total,
+                   sum(nb_declarations)     AS nb_declarations,
+                   count(DISTINCT lab_key)  AS nb_labs,
+                   min(annee)               AS first_annee,
+                   max(annee)               AS last_annee
+            FROM hcp_profile_payments
+            WHERE true {_rpps_filter("numero_rpps", dirty)}
+            GROUP BY numero_rpps
+        ) p
+        LEFT JOIN dim_hcp h ON h.numero_rpps = p.numero_rpps
+        LEFT JOIN _psp_spe_map s ON s.code_savoir_faire = h.code_savoir_faire
+        LEFT JOIN (
+            SELECT code_departement, any_value(code_region) AS code_region
+            FROM dim_geography GROUP BY code_departement
+        ) r ON r.code_departement = h.code_departement_exercice
+        ORDER BY p.numero_rpps
+    """)
+    conn.unregister("_psp_spe_map")
+
+
+def _build_context(conn: duckdb.DuckDBPyConnection) -> None:
+    conn.execute("DELETE FROM hcp_prescribing_context")
+    ben_reg = arrow_table(conn.execute(
+        "SELECT DISTINCT ben_reg FROM fact_prescriptions WHERE ben_reg IS NOT NULL"
+    )).column("ben_reg")
+    # Older vintages use pre-2016 region codes
+    conn.register("_region_map", pa.table({
+        "ben_reg": ben_reg,
+        "code_region": resolve_region_codes(ben_reg),
+    }))
+    conn.execute("""
+        INSERT INTO hcp_prescribing_context
+        -- PSP_SPE may be zero-padded depending on the Open Medic vintage
+        SELECT r.code_region,
+               coalesce(CAST(try_cast(f.hcp_profession_code AS INTEGER) AS VARCHAR),
+                        f.hcp_profession_code),
+               f.annee,
+               sum(f.nb_boites), sum(f.montant_rembourse)
+        FROM fact_prescriptions f
+        JOIN _region_map r ON r.ben_reg = f.ben_reg
+        GROUP BY ALL
+        ORDER BY ALL
+    """)
+    conn.unregister("_region_map")
+
+
+def build_profiles(conn: duckdb.DuckDBPyConnection) -> int:
+    """Rebuild every profile table from scratch (re-sorts by RPPS).
+
+    Returns the ledger ``load_id`` recorded for the build.
+    """
+    ensure_ledger(conn)
+    ensure_profile_tables(conn)
+    conn.execute("BEGIN TRANSACTION")
+    try:
+        conn.execute("DELETE FROM hcp_profile")
+        conn.execute("DELETE FROM hcp_profile_payments")
+        conn.execute("DELETE FROM hcp_profile_pending_rpps")
+        _insert_profiles(conn, dirty=False)
+        _build_context(conn)
+        n = conn.execute("SELECT count(*) FROM hcp_profile").fetchone()[0]
+        load_id = record_load(conn, PROFILE_DATASET, "hcp_profile", rows_affected=n,
+                              source_vintage="full")
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    logger.info("Built %d HCP profiles (load_id=%d)", n, load_id)
+    return load_id
+
+
+def _pending_loads(
+    conn: duckdb.DuckDBPyConnection,
+) -> list[tuple[int, str, str | None, bool]] | None:
+    """Ledger loads since the last profile build, or None if profiles were never built.
+
+    Each load is ``(load_id, target_table, source_vintage, declared_rpps)``.
+    """
+    row = conn.execute(
+        f"SELECT max(load_id) FROM {LOAD_LEDGER_TABLE} WHERE dataset = ?", [PROFILE_DATASET]
+    ).fetchone()
+    if row[0] is None:
+        return None
+    return conn.execute(
+        f"SELECT load_id, target_table, source_vintage, "
+        f"load_id IN (SELECT load_id FROM hcp_profile_pending_rpps) "
+        f"FROM {LOAD_LEDGER_TABLE} "
+        "WHERE load_id > ? AND target_table IN "
+        "('dim_hcp', 'dim_geography', 'fact_pharma_payments', 'fact_prescriptions') "
+        "ORDER BY load_id",
+        [row[0]],
+    ).fetchall()
+
+
+def refresh_profiles(conn: duckdb.DuckDBPyConnection) -> int | None:
+    """Bring the profile tables up to date with the warehouse.
+
+    RPPS to recompute come from the ledger. ``dim_hcp`` loads name a vintage
+    whose rows in ``dim_hcp_history`` list the changed RPPS (see etl.snapshot).
+    ``fact_pharma_payments`` loads list theirs in ``hcp_profile_pending_rpps``
+    (see ``record_payment_rpps``). Anything else falls back to a full build.
+    Returns the new ``load_id``, or None if nothing changed.
+    """
+    ensure_ledger(conn)
+    ensure_profile_tables(conn)
+    pending = _pending_loads(conn)
+    if pending is None or any(
+        target == "dim_geography"
+        or (target == "dim_hcp" and not vintage)
+        or (target == "fact_pharma_payments" and not declared)
+        for _, target, vintage, declared in pending
+    ):
+        return build_profiles(conn)
+    if not pending:
+        logger.info("HCP profiles are up to date")
+        return None
+
+    hcp_vintages = [v for _, t, v, _ in pending if t == "dim_hcp"]
+    payment_loads = [i for i, t, _, _ in pending if t == "fact_pharma_payments"]
+    context_dirty = any(t == "fact_prescriptions" for _, t, _, _ in pending)
+
+    conn.execute("BEGIN TRANSACTION")
+    try:
+        conn.execute("CREATE OR REPLACE TEMP TABLE _dirty_rpps (numero_rpps VARCHAR)")
+        if hcp_vintages:
+            conn.execute(
+                f"INSERT INTO _dirty_rpps SELECT DISTINCT numero_rpps "
+                f"FROM {history_table(SNAPSHOT_SPECS['rpps'])} WHERE list_contains(?, vintage_id)",
+                [hcp_vintages],
+            )
+        if payment_loads:
+            conn.execute(
+                "INSERT INTO _dirty_rpps SELECT DISTINCT numero_rpps "
+                "FROM hcp_profile_pending_rpps WHERE list_contains(?, load_id)",
+                [payment_loads],
+            )
+            conn.execute(
+                "DELETE FROM hcp_profile_pending_rpps WHERE list_contains(?, load_id)",
+                [payment_loads],
+            )
+        conn.execute(
+            "DELETE FROM hcp_profile WHERE numero_rpps IN (SELECT numero_rpps FROM _dirty_rpps)"
+        )
+        conn.execute(
+            "DELETE FROM hcp_profile_payments "
+            "WHERE numero_rpps IN (SELECT numero_rpps FROM _dirty_rpps)"
+        )
+        _insert_profiles(conn, dirty=True)
+        if context_dirty:
+            _build_context(conn)
+        n = conn.execute("SELECT count(DISTINCT numero_rpps) FROM _dirty_rpps").fetchone()[0]
+        conn.execute("DROP TABLE _dirty_rpps")
+        load_id = record_load(conn, PROFILE_DATASET, "hcp_profile", rows_affected=n,
+                              source_vintage="incremental")
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    logger.info("Refreshed %d HCP profiles (load_id=%d)", n, load_id)
+    return load_id
+
+
+# ---------------------------------------------------------------------------
+# In-memory store
+# ---------------------------------------------------------------------------
+
+def _rpps_range(keys: pa.Array, numero_rpps: str) -> tuple[int, int]:
+    """Row range of ``numero_rpps`` in a sorted RPPS column, by binary search in place."""
+    lo = bisect_left(keys, numero_rpps, key=_as_py)
+    hi = bisect_right(keys, numero_rpps, lo=lo, key=_as_py)
+    return lo, hi
+
+
+def _as_py(scalar: pa.Scalar) -> object:
+    return scalar.as_py()
+
+
+class ProfileStore:
+    """RPPS-sorted, read-only view of the profile tables for fast lookups.
+
+    ``profiles`` must be sorted by ``numero_rpps`` and ``payments`` by
+    (``numero_rpps``, ``annee``), as ``from_warehouse`` reads them. Single-HCP
+    lookups binary-search the Arrow RPPS columns directly and slice the
+    tables; top-N queries only touch ``hcp_profile``.
+    """
+
+    def __init__(self, profiles: pa.Table, payments: pa.Table, context: pa.Table) -> None:
+        self.profiles = profiles
+        self.payments = payments
+        self.context = context
+        self._profile_keys = profiles.column("numero_rpps").combine_chunks()
+        self._payment_keys = payments.column("numero_rpps").combine_chunks()
+        self._context: dict[tuple[str, str], list[dict]] = {}
+        for row in context.to_pylist():
+            key = (row["code_region"], row["hcp_profession_code"])
+            self._context.setdefault(key, []).append(row)
+
+    @classmethod
+    def from_warehouse(cls, conn: duckdb.DuckDBPyConnection) -> ProfileStore:
+        return cls(
+            arrow_table(conn.execute("SELECT * FROM hcp_profile ORDER BY numero_rpps")),
+            arrow_table(conn.execute(
+                "SELECT * FROM hcp_profile_payments ORDER BY numero_rpps, annee"
+            )),
+            arrow_table(conn.execute("SELECT * FROM hcp_prescribing_context")),
+        )
+
+    def __len__(self) -> int:
+        return len(self._profile_keys)
+
+    def __contains__(self, numero_rpps: str) -> bool:
+        lo, hi = _rpps_range(self._profile_keys, numero_rpps)
+        return hi > lo
+
+    def get(self, numero_rpps: str) -> dict | None:
+        """Return the profile of one HCP, with its payment breakdown and prescribing context.
+
+        The context is matched on (``code_region``, ``psp_spe``): the HCP's
+        region of practice and savoir-faire translated to the Open Medic
+        prescriber specialty through ``SAVOIR_FAIRE_PSP_SPE``. Open Medic only
+        has the beneficiaries' region, so this is regional market context, not
+        the HCP's own prescribing.
+        """
+        i, end = _rpps_range(self._profile_keys, numero_rpps)
+        if end == i:
+            return None
+        profile = self.profiles.slice(i, 1).to_pylist()[0]
+        lo, hi = _rpps_range(self._payment_keys, numero_rpps)
+        profile["payments"] = self.payments.slice(lo, hi - lo).to_pylist()
+        profile["prescribing_context"] = self._context.get(
+            (profile["code_region"], profile["psp_spe"]), []
+        )
+        return profile
+
+    def top_n(
+        self,
+        code_departement: str | None = None,
+        n: int = 20,
+        by: str = "montant_ttc_total",
+    ) -> pa.Table:
+        """Top-N HCPs by ``by`` (optionally within one département), from profiles only."""
+        table = self.profiles
+        if code_departement is not None:
+            table = table.filter(pc.equal(table.column("code_departement"), code_departement))
+        return table.take(pc.select_k_unstable(table, k=min(n, table.num_rows),
+                                               sort_keys=[(by, "descending")]))
+
+
+# ---------------------------------------------------------------------------
+# CLI entry point
+# ---------------------------------------------------------------------------
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Build or refresh the HCP profile store")
+    parser.add_argument("--full", action="store_true", help="Rebuild every profile from scratch")
+    args = parser.parse_args()
+
+    conn = duckdb.connect(str(get_settings().duckdb_path))
+    try:
+        if args.full:
+            build_profiles(conn)
+        else:
+            refresh_profiles(conn)
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
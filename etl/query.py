@@ -0,0 +1,413 @@
+"""
+Read-only query service over the PharmaScope DuckDB warehouse.
+
+Serves parameterized named queries from a pool of read-only DuckDB connections,
+streams results as Arrow record batches and keeps an LRU result cache keyed by
+the load ledger version (see ``etl.ledger``).
+
+Usage:
+    python -m etl.query --list                                    # List named queries
+    python -m etl.query top_molecules_atc_year atc_prefix=C10 annee=2023
+"""
+
+from __future__ import annotations
+
+import argparse
+import threading
+from collections import OrderedDict
+from collections.abc import Iterator
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+from etl.utils import arrow_reader, get_settings, setup_logging
+
+if TYPE_CHECKING:
+    import duckdb
+    import pyarrow as pa
+
+# duckdb, pyarrow and etl.ledger are imported where they are used: `--list`
+# must not pay for them.
+
+logger = setup_logging("etl.query")
+
+
+# ---------------------------------------------------------------------------
+# Named query registry
+# ---------------------------------------------------------------------------
+
+@dataclass(frozen=True)
+class NamedQuery:
+    """A parameterized SQL query exposed by the service.
+
+    ``sql`` uses DuckDB named parameters (``$annee``); ``params`` maps the
+    required ones to their Python type and ``defaults`` fills in the optional
+    ones (typed after their default value).
+    """
+
+    name: str
+    description: str
+    sql: str
+    params: dict[str, type] = field(default_factory=dict)
+    defaults: dict[str, object] = field(default_factory=dict)
+
+    def param_type(self, param: str) -> type | None:
+        if param in self.params:
+            return self.params[param]
+        if param in self.defaults:
+            return type(self.defaults[param])
+        return None
+
+
+QUERIES: dict[str, NamedQuery] = {
+    "top_molecules_atc_year": NamedQuery(
+        name="top_molecules_atc_year",
+        description="Top molecules by reimbursed amount for an ATC prefix and year (Open Medic)",
+        sql="""
+            SELECT m.code_atc,
+                   m.substance_active,
+                   sum(f.nb_boites)          AS nb_boites,
+                   sum(f.montant_rembourse)  AS montant_rembourse
+            FROM fact_prescriptions f
+            JOIN dim_molecule m ON m.molecule_key = f.molecule_key
+            WHERE m.code_atc LIKE $atc_prefix || '%'
+              AND f.annee = $annee
+            GROUP BY m.code_atc, m.substance_active
+            ORDER BY montant_rembourse DESC NULLS LAST
+            LIMIT $limit
+        """,
+        params={"atc_prefix": str, "annee": int},
+        defaults={"limit": 20},
+    ),
+    "payments_lab_departement": NamedQuery(
+        name="payments_lab_departement",
+        description="Transparence Santé payments per lab in a département for a year",
+        sql="""
+            SELECT l.lab_name_raw,
+                   g.code_departement,
+                   count(*)            AS nb_declarations,
+                   sum(p.montant_ttc)  AS montant_ttc
+            FROM fact_pharma_payments p
+            JOIN dim_lab l ON l.lab_key = p.lab_key
+            JOIN dim_geography g ON g.geo_key = p.geo_key
+            WHERE g.code_departement = $code_departement
+              AND p.annee = $annee
+            GROUP BY l.lab_name_raw, g.code_departement
+            ORDER BY montant_ttc DESC NULLS LAST
+            LIMIT $limit
+        """,
+        params={"code_departement": str, "annee": int},
+        defaults={"limit": 50},
+    ),
+    "prescriptions_departement_year": NamedQuery(
+        name="prescriptions_departement_year",
+        description="Reimbursed amount and boxes per prescriber département for a year",
+        sql="""
+            SELECT g.code_departement,
+                   g.nom_departement,
+                   sum(f.nb_boites)          AS nb_boites,
+                   sum(f.montant_rembourse)  AS montant_rembourse
+            FROM fact_prescriptions f
+            JOIN dim_geography g ON g.geo_key = f.geo_prescriber_key
+            WHERE f.annee = $annee
+            GROUP BY g.code_departement, g.nom_departement
+            ORDER BY g.code_departement
+        """,
+        params={"annee": int},
+    ),
+    "top_paid_hcp_year": NamedQuery(
+        name="top_paid_hcp_year",
+        description="HCPs receiving the highest total payments in a year",
+        sql="""
+            SELECT p.numero_rpps,
+                   h.nom_exercice,
+                   h.prenom_exercice,
+                   h.libelle_savoir_faire,
+                   count(DISTINCT p.lab_key)  AS nb_labs,
+                   sum(p.montant_ttc)         AS montant_ttc
+            FROM fact_pharma_payments p
+            LEFT JOIN dim_hcp h ON h.numero_rpps = p.numero_rpps
+            WHERE p.annee = $annee
+              AND p.numero_rpps IS NOT NULL
+            GROUP BY ALL
+            ORDER BY montant_ttc DESC NULLS LAST
+            LIMIT $limit
+        """,
+        params={"annee": int},
+        defaults={"limit": 100},
+    ),
+    "top_hcp_profiles_departement": NamedQuery(
+        name="top_hcp_profiles_departement",
+        description="Most-paid HCPs of a département, from the profile store (etl.profiles)",
+        sql="""
+            SELECT numero_rpps,
+                   nom_exercice,
+                   prenom_exercice,
+                   libelle_savoir_faire,
+                   nb_labs,
+                   montant_ttc_total
+            FROM hcp_profile
+            WHERE code_departement = $code_departement
+            ORDER BY montant_ttc_total DESC NULLS LAST
+            LIMIT $limit
+        """,
+        params={"code_departement": str},
+        defaults={"limit": 50},
+    ),
+}
+
+
+def _bind_params(query: NamedQuery, params: dict[str, object]) -> dict[str, object]:
+    """Merge defaults and check that exactly the declared parameters are given."""
+    bound = {**query.defaults, **params}
+    missing = [p for p in query.params if p not in bound]
+    if missing:
+        raise ValueError(f"Query {query.name!r} is missing parameters: {', '.join(missing)}")
+    unknown = set(bound) - set(query.params) - set(query.defaults)
+    if unknown:
+        raise ValueError(
+            f"Query {query.name!r} got unknown parameters: {', '.join(sorted(unknown))}"
+        )
+    return bound
+
+
+# ---------------------------------------------------------------------------
+# Result cache
+# ---------------------------------------------------------------------------
+
+class ResultCache:
+    """Thread-safe LRU cache of Arrow record batches, bounded by total size in bytes."""
+
+    def __init__(self, max_bytes: int) -> None:
+        self.max_bytes = max_bytes
+        self._entries: OrderedDict[tuple, tuple[pa.Schema, list[pa.RecordBatch], int]] = (
+            OrderedDict()
+        )
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    @property
+    def nbytes(self) -> int:
+        return self._bytes
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: tuple) -> tuple[pa.Schema, list[pa.RecordBatch]] | None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            return entry[0], entry[1]
+
+    def put(self, key: tuple, schema: pa.Schema, batches: list[pa.RecordBatch]) -> None:
+        size = sum(b.nbytes for b in batches)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old[2]
+            self._entries[key] = (schema, batches, size)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, (_, _, evicted) = self._entries.popitem(last=False)
+                self._bytes -= evicted
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+
+# ---------------------------------------------------------------------------
+# Connection pool
+# ---------------------------------------------------------------------------
+
+class ConnectionPool:
+    """Bounded pool of short-lived read-only DuckDB connections.
+
+    A connection is opened on checkout and closed on release, so the database
+    file lock is only held while a query runs and loaders in other processes
+    can write (and bump the ledger) in between.
+    """
+
+    def __init__(self, db_path: Path, size: int = 4) -> None:
+        self.db_path = db_path
+        self._slots = threading.BoundedSemaphore(size)
+
+    def acquire(self, timeout: float | None = None) -> duckdb.DuckDBPyConnection:
+        """Open a connection, blocking until a slot is free."""
+        import duckdb
+
+        if not self._slots.acquire(timeout=timeout):
+            raise TimeoutError(f"No free connection to {self.db_path} after {timeout}s")
+        try:
+            return duckdb.connect(str(self.db_path), read_only=True)
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def release(self, conn: duckdb.DuckDBPyConnection) -> None:
+        try:
+            conn.close()
+        finally:
+            self._slots.release()
+
+
+# ---------------------------------------------------------------------------
+# Query service
+# ---------------------------------------------------------------------------
+
+class QueryService:
+    """Serve named queries as Arrow record batch streams with ledger-aware caching."""
+
+    def __init__(
+        self,
+        db_path: Path | None = None,
+        pool_size: int = 4,
+        cache_bytes: int = 256 * 1024 * 1024,
+        batch_rows: int = 65536,
+    ) -> None:
+        self.db_path = Path(db_path) if db_path is not None else get_settings().duckdb_path
+        self.batch_rows = batch_rows
+        self.cache = ResultCache(cache_bytes)
+        self._pool = ConnectionPool(self.db_path, pool_size)
+        self._version: int | None = None
+        self._version_lock = threading.Lock()
+
+    def __enter__(self) -> QueryService:
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self.cache.clear()
+
+    def _check_version(self, conn: duckdb.DuckDBPyConnection) -> int:
+        """Read the ledger version and drop the whole cache if it moved."""
+        from etl.ledger import ledger_version
+
+        version = ledger_version(conn)
+        with self._version_lock:
+            if version != self._version:
+                if self._version is not None:
+                    logger.info("Ledger version %s -> %s, clearing cache", self._version, version)
+                self.cache.clear()
+                self._version = version
+        return version
+
+    def run(self, name: str, **params: object) -> pa.RecordBatchReader:
+        """Execute a named query and return its result as a record batch stream.
+
+        The connection stays open until the stream is exhausted or the reader
+        is garbage-collected; cache hits close it before returning.
+        """
+        import duckdb
+        import pyarrow as pa
+
+        if name not in QUERIES:
+            raise KeyError(f"Unknown query: {name}")
+        query = QUERIES[name]
+        bound = _bind_params(query, params)
+
+        params_key = tuple(sorted(bound.items()))
+        try:
+            conn = self._pool.acquire()
+        except duckdb.IOException:
+            # A loader holds the write lock: serve the last known result if there is one
+            cached = self.cache.get((name, params_key, self._version))
+            if cached is None:
+                raise
+            logger.warning("Warehouse locked by a writer, serving cached %s", name)
+            schema, batches = cached
+            return pa.RecordBatchReader.from_batches(schema, batches)
+
+        try:
+            version = self._check_version(conn)
+            key = (name, params_key, version)
+            cached = self.cache.get(key)
+            if cached is not None:
+                self._pool.release(conn)
+                schema, batches = cached
+                return pa.RecordBatchReader.from_batches(schema, batches)
+            reader = arrow_reader(conn.execute(query.sql, bound), self.batch_rows)
+        except BaseException:
+            self._pool.release(conn)
+            raise
+
+        return pa.RecordBatchReader.from_batches(
+            reader.schema, self._stream_and_cache(conn, reader, key)
+        )
+
+    def _stream_and_cache(
+        self,
+        conn: duckdb.DuckDBPyConnection,
+        reader: pa.RecordBatchReader,
+        key: tuple,
+    ) -> Iterator[pa.RecordBatch]:
+        """Yield batches to the caller, caching the full result once it is exhausted."""
+        batches: list[pa.RecordBatch] | None = []
+        size = 0
+        try:
+            for batch in reader:
+                if batches is not None:
+                    size += batch.nbytes
+                    if size > self.cache.max_bytes:
+                        batches = None
+                    else:
+                        batches.append(batch)
+                yield batch
+            # A stream that outlived a ledger bump must not cache a dead version
+            with self._version_lock:
+                if batches is not None and key[-1] == self._version:
+                    self.cache.put(key, reader.schema, batches)
+        finally:
+            self._pool.release(conn)
+
+    def run_table(self, name: str, **params: object) -> pa.Table:
+        """Execute a named query and materialize the full result as an Arrow table."""
+        return self.run(name, **params).read_all()
+
+
+# ---------------------------------------------------------------------------
+# CLI entry point
+# ---------------------------------------------------------------------------
+
+def _parse_param(query: NamedQuery, raw: str) -> tuple[str, object]:
+    """Parse ``key=value`` into the parameter's declared type (codes stay strings)."""
+    key, _, value = raw.partition("=")
+    param_type = query.param_type(key)
+    if param_type is None or param_type is str:
+        return key, value
+    try:
+        return key, param_type(value)
+    except ValueError:
+        raise ValueError(
+            f"Query {query.name!r}: {key}={value!r} is not a valid {param_type.__name__}"
+        ) from None
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Run a named query against the warehouse")
+    parser.add_argument("query", nargs="?", choices=list(QUERIES.keys()))
+    parser.add_argument("params", nargs="*", help="Query parameters as key=value")
+    parser.add_argument("--list", action="store_true", help="List named queries and exit")
+    args = parser.parse_args()
+
+    if args.list or not args.query:
+        for name, q in QUERIES.items():
+            print(f"  {name:32s} — {q.description} ({', '.join(q.params)})")
+        return
+
+    query = QUERIES[args.query]
+    params = dict(_parse_param(query, p) for p in args.params)
+    with QueryService() as service:
+        table = service.run_table(args.query, **params)
+    print(table.to_pandas().to_string(index=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,527 @@
+"""
+Snapshot diff engine for full-extract registries (RPPS, FINESS).
+
+Each download of a snapshot dataset (``DatasetConfig.snapshot``) first archives
+the previous files as a *vintage* under ``<dataset>/_vintages/<vintage_id>/``,
+hard-linked so it costs no extra disk. Two vintages are then compared by
+natural key to produce an insert/update/delete change set, which is applied to
+the dimension table and to an SCD2-style ``<table>_history`` table.
+
+The comparison is a DuckDB FULL OUTER hash join run under a fixed
+``memory_limit`` with a spill directory, so memory stays bounded regardless of
+registry size.
+
+Usage:
+    python -m etl.snapshot rpps             # Show the change set vs. the last applied vintage
+    python -m etl.snapshot rpps --apply     # ...and apply it to the warehouse
+"""
+
+from __future__ import annotations
+
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from dataclasses import dataclass, field
+from datetime import datetime
+from fnmatch import fnmatch
+from pathlib import Path
+
+import duckdb
+
+from etl.config import DATASETS
+from etl.ledger import LOAD_LEDGER_TABLE, ensure_ledger, record_load
+from etl.utils import get_raw_dir, get_settings, setup_logging
+
+logger = setup_logging("etl.snapshot")
+
+VINTAGES_DIR = "_vintages"
+
+
+# ---------------------------------------------------------------------------
+# Snapshot specs — how a raw extract maps onto its dimension table
+# ---------------------------------------------------------------------------
+
+@dataclass(frozen=True)
+class SnapshotSpec:
+    """Mapping from a registry extract to its dimension table.
+
+    ``columns`` maps each dimension column to a SQL expression over the raw
+    file's columns. ``surrogate_key`` is assigned on insert only.
+    """
+
+    dataset: str
+    target_table: str
+    surrogate_key: str
+    natural_key: str
+    file_glob: str
+    columns: dict[str, str]
+    header: bool = True
+    raw_names: list[str] = field(default_factory=list)  # when header=False
+    row_filter: str = "true"
+
+    @property
+    def tracked_columns(self) -> list[str]:
+        return [c for c in self.columns if c != self.natural_key]
+
+
+def departement_of_commune(commune: str) -> str:
+    """SQL expression deriving the département code from an INSEE commune code.
+
+    Overseas communes (97x, 98x) carry a 3-char département; Corsica keeps
+    ``2A``/``2B`` as the first two characters like every other département.
+    """
+    code = f"nullif(trim({commune}), '')"
+    return (
+        f"CASE WHEN left({code}, 2) IN ('97', '98') THEN left({code}, 3) "
+        f"ELSE left({code}, 2) END"
+    )
+
+
+# FINESS codes overseas départements as 9A-9F instead of their INSEE 971-976
+FINESS_DOM_DEPARTEMENTS: dict[str, str] = {
+    "9A": "971",  # Guadeloupe
+    "9B": "972",  # Martinique
+    "9C": "973",  # Guyane
+    "9D": "974",  # La Réunion
+    "9E": "975",  # Saint-Pierre-et-Miquelon
+    "9F": "976",  # Mayotte
+}
+
+
+def _finess_departement(departement: str) -> str:
+    """SQL expression mapping a FINESS département code to its INSEE code."""
+    cases = " ".join(
+        f"WHEN '{finess}' THEN '{insee}'"
+        for finess, insee in FINESS_DOM_DEPARTEMENTS.items()
+    )
+    return f"CASE {departement} {cases} ELSE {departement} END"
+
+
+SNAPSHOT_SPECS: dict[str, SnapshotSpec] = {
+    "rpps": SnapshotSpec(
+        dataset="rpps",
+        target_table="dim_hcp",
+        surrogate_key="hcp_key",
+        natural_key="numero_rpps",
+        file_glob="*Personne_activite*.txt",
+        columns={
+            "numero_rpps": '"Identifiant PP"',
+            "nom_exercice": '"Nom d\'exercice"',
+            "prenom_exercice": '"Prénom d\'exercice"',
+            "code_profession": '"Code profession"',
+            "libelle_profession": '"Libellé profession"',
+            "code_categorie_pro": '"Code catégorie professionnelle"',
+            "libelle_categorie_pro": '"Libellé catégorie professionnelle"',
+            "code_savoir_faire": '"Code savoir-faire"',
+            "libelle_savoir_faire": '"Libellé savoir-faire"',
+            "code_mode_exercice": '"Code mode exercice"',
+            "libelle_mode_exercice": '"Libellé mode exercice"',
+            "code_commune_exercice": '"Code commune (coord. structure)"',
+            "code_departement_exercice": departement_of_commune(
+                '"Code commune (coord. structure)"'
+            ),
+        },
+    ),
+    "finess": SnapshotSpec(
+        dataset="finess",
+        target_table="dim_establishment",
+        surrogate_key="establishment_key",
+        natural_key="numero_finess_et",
+        file_glob="etalab-cs1100507*.csv",
+        header=False,
+        raw_names=[
+            "section", "nofinesset", "nofinessej", "rs", "rslongue", "complrs",
+            "compldistrib", "numvoie", "typvoie", "voie", "compvoie", "lieuditbp",
+            "commune", "departement", "libdepartement", "ligneacheminement",
+            "telephone", "telecopie", "categetab", "libcategetab", "categagretab",
+            "libcategagretab", "siret", "codeape", "codemft", "libmft", "codesph",
+            "libsph", "dateouv", "dateautor", "datemaj", "numuai",
+        ],
+        row_filter="section = 'structureet'",
+        columns={
+            "numero_finess_et": "nofinesset",
+            "numero_finess_ej": "nofinessej",
+            "raison_sociale": "rs",
+            "categorie_code": "categetab",
+            "categorie_libelle": "libcategetab",
+            # FINESS commune is 3 chars: 9A + 101 -> 97101, 2A + 004 -> 2A004
+            "code_commune_insee": f"left({_finess_departement('departement')}, 2) || commune",
+            "code_departement": _finess_departement("departement"),
+            "adresse": "concat_ws(' ', numvoie, typvoie, voie)",
+            "code_postal": "left(ligneacheminement, 5)",
+            "telephone": "telephone",
+            "date_ouverture": "try_cast(dateouv AS DATE)",
+        },
+    ),
+}
+
+
+# ---------------------------------------------------------------------------
+# Vintages
+# ---------------------------------------------------------------------------
+
+@dataclass(frozen=True)
+class Vintage:
+    """One downloaded state of a dataset directory, identified by its content."""
+
+    vintage_id: str
+    path: Path
+    downloaded_at: str
+
+
+def _read_metadata(path: Path) -> dict:
+    meta_path = path / "_metadata.json"
+    if meta_path.exists():
+        return json.loads(meta_path.read_text(encoding="utf-8"))
+    return {"files": {}}
+
+
+def vintage_of(path: Path) -> Vintage | None:
+    """Describe the files in ``path`` as a vintage (None if nothing was downloaded).
+
+    The id is ``<latest download time>_<hash of file digests>``: it sorts
+    chronologically and stays stable when a re-run downloads nothing new.
+    """
+    files = _read_metadata(path).get("files", {})
+    if not files:
+        return None
+    digest = hashlib.sha256(
+        "".join(f"{name}:{meta.get('sha256', '')}" for name, meta in sorted(files.items())).encode()
+    ).hexdigest()[:8]
+    downloaded_at = max(meta.get("downloaded_at", "") for meta in files.values())
+    stamp = datetime.fromisoformat(downloaded_at).strftime("%Y%m%dT%H%M%S")
+    return Vintage(f"{stamp}_{digest}", path, downloaded_at)
+
+
+def list_vintages(dataset_dir: Path) -> list[Vintage]:
+    """Return the archived vintages of a dataset, oldest first."""
+    root = dataset_dir / VINTAGES_DIR
+    if not root.exists():
+        return []
+    vintages = [vintage_of(p) for p in sorted(root.iterdir()) if p.is_dir()]
+    return [v for v in vintages if v is not None]
+
+
+def archive_vintage(dataset_dir: Path) -> Vintage | None:
+    """Hard-link the current files of ``dataset_dir`` into ``_vintages/``.
+
+    Called before a download overwrites them. Downloads replace files by
+    renaming, so the archived links keep pointing at the old content.
+    """
+    current = vintage_of(dataset_dir)
+    if current is None:
+        return None
+    dest = dataset_dir / VINTAGES_DIR / current.vintage_id
+    if dest.exists():
+        return vintage_of(dest)
+
+    dest.mkdir(parents=True)
+    for filename in _read_metadata(dataset_dir)["files"]:
+        src = dataset_dir / filename
+        if not src.exists():
+            continue
+        try:
+            os.link(src, dest / filename)
+        except OSError:
+            shutil.copy2(src, dest / filename)
+    shutil.copy2(dataset_dir / "_metadata.json", dest / "_metadata.json")
+    logger.info("Archived %s vintage %s", dataset_dir.name, current.vintage_id)
+    return vintage_of(dest)
+
+
+# ---------------------------------------------------------------------------
+# Diff
+# ---------------------------------------------------------------------------
+
+@dataclass(frozen=True)
+class ChangeSet:
+    """Insert/update/delete rows between two vintages, stored as Parquet.
+
+    Columns: ``op``, the natural key, every tracked column (new values; NULL
+    for deletes) and ``changed_columns`` (the tracked columns that differ).
+    """
+
+    dataset: str
+    path: Path
+    old_vintage: str | None
+    new_vintage: str
+    new_downloaded_at: str
+    counts: dict[str, int]
+
+
+def _sql_str(value: str) -> str:
+    return "'" + value.replace("'", "''") + "'"
+
+
+def _staging_sql(spec: SnapshotSpec, vintage_dir: Path) -> str:
+    """SELECT producing one row per natural key from a vintage's raw files.
+
+    Only the files listed in the vintage's ``_metadata.json`` are read: stale
+    extracts left next to them must not mask the current one.
+    """
+    listed = _read_metadata(vintage_dir).get("files", {})
+    files = [vintage_dir / name for name in sorted(listed) if fnmatch(name, spec.file_glob)]
+    if not files:
+        raise FileNotFoundError(f"No {spec.file_glob} in {vintage_dir}")
+    cfg = DATASETS[spec.dataset]
+    options = [
+        f"delim={_sql_str(cfg.separator)}",
+        f"header={str(spec.header).lower()}",
+        "all_varchar=true",
+        "null_padding=true",
+    ]
+    if spec.raw_names:
+        options.append(f"names=[{', '.join(_sql_str(n) for n in spec.raw_names)}]")
+    file_list = ", ".join(_sql_str(str(f)) for f in files)
+    select = ",\n        ".join(f"{expr} AS {col}" for col, expr in spec.columns.items())
+    # Registries repeat a person/site once per activity: keep one deterministic row
+    order = ", ".join(spec.tracked_columns)
+    return f"""
+        SELECT {select}
+        FROM read_csv([{file_list}], {', '.join(options)})
+        WHERE {spec.row_filter}
+        QUALIFY {spec.natural_key} IS NOT NULL
+            AND row_number() OVER (PARTITION BY {spec.natural_key} ORDER BY {order}) = 1
+    """
+
+
+def _work_connection(memory_limit: str, temp_dir: Path) -> duckdb.DuckDBPyConnection:
+    conn = duckdb.connect(":memory:")
+    conn.execute(f"SET memory_limit = {_sql_str(memory_limit)}")
+    conn.execute(f"SET temp_directory = {_sql_str(str(temp_dir))}")
+    conn.execute("SET preserve_insertion_order = false")
+    return conn
+
+
+def diff_vintages(
+    spec: SnapshotSpec,
+    old: Path | None,
+    new: Path,
+    out_path: Path,
+    memory_limit: str = "1GB",
+) -> ChangeSet:
+    """Compare two vintage directories by natural key and write the change set.
+
+    ``old=None`` diffs against an empty registry (initial load: all inserts).
+    """
+    new_vintage = vintage_of(new)
+    if new_vintage is None:
+        raise FileNotFoundError(f"No downloaded files recorded in {new / '_metadata.json'}")
+    old_vintage = vintage_of(old) if old is not None else None
+
+    key = spec.natural_key
+    tracked = spec.tracked_columns
+    new_sql = _staging_sql(spec, new)
+    old_sql = _staging_sql(spec, old) if old is not None else f"SELECT * FROM ({new_sql}) LIMIT 0"
+    changed = ", ".join(
+        f"CASE WHEN o.{c} IS DISTINCT FROM n.{c} THEN '{c}' END" for c in tracked
+    )
+
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    with tempfile.TemporaryDirectory(prefix="snapshot_", dir=out_path.parent) as spill:
+        conn = _work_connection(memory_limit, Path(spill))
+        try:
+            conn.execute(f"""
+                COPY (
+                    WITH o AS ({old_sql}), n AS ({new_sql})
+                    SELECT
+                        CASE WHEN o.{key} IS NULL THEN 'insert'
+                             WHEN n.{key} IS NULL THEN 'delete'
+                             ELSE 'update' END AS op,
+                        coalesce(n.{key}, o.{key}) AS {key},
+                        {', '.join(f'n.{c}' for c in tracked)},
+                        list_filter([{changed}], x -> x IS NOT NULL) AS changed_columns
+                    FROM o FULL OUTER JOIN n ON o.{key} = n.{key}
+                    WHERE o.{key} IS NULL OR n.{key} IS NULL
+                       OR row({', '.join(f'o.{c}' for c in tracked)})
+                          IS DISTINCT FROM row({', '.join(f'n.{c}' for c in tracked)})
+                    ORDER BY {key}
+                ) TO {_sql_str(str(out_path))} (FORMAT parquet)
+            """)
+            counts = dict(
+                conn.execute(
+                    f"SELECT op, count(*) FROM read_parquet({_sql_str(str(out_path))}) GROUP BY op"
+                ).fetchall()
+            )
+        finally:
+            conn.close()
+
+    changeset = ChangeSet(
+        dataset=spec.dataset,
+        path=out_path,
+        old_vintage=old_vintage.vintage_id if old_vintage else None,
+        new_vintage=new_vintage.vintage_id,
+        new_downloaded_at=new_vintage.downloaded_at,
+        counts={op: counts.get(op, 0) for op in ("insert", "update", "delete")},
+    )
+    logger.info(
+        "%s %s -> %s: %s",
+        spec.dataset, changeset.old_vintage, changeset.new_vintage, changeset.counts,
+    )
+    return changeset
+
+
+# ---------------------------------------------------------------------------
+# Apply
+# ---------------------------------------------------------------------------
+
+def history_table(spec: SnapshotSpec) -> str:
+    return f"{spec.target_table}_history"
+
+
+def ensure_history(conn: duckdb.DuckDBPyConnection, spec: SnapshotSpec) -> None:
+    """Create the SCD2 history table, typed after the dimension columns.
+
+    It keeps the surrogate key so facts pointing at a deleted row still resolve,
+    and so deleted keys are never handed out again.
+    """
+    cols = ", ".join([spec.surrogate_key, *spec.columns])
+    conn.execute(f"""
+        CREATE TABLE IF NOT EXISTS {history_table(spec)} AS
+        SELECT {cols},
+               NULL::VARCHAR(6)    AS change_op,
+               NULL::VARCHAR(40)   AS vintage_id,
+               NULL::TIMESTAMPTZ   AS valid_from,
+               NULL::TIMESTAMPTZ   AS valid_to,
+               NULL::BOOLEAN       AS is_current
+        FROM {spec.target_table} LIMIT 0
+    """)
+
+
+def apply_changeset(conn: duckdb.DuckDBPyConnection, changeset: ChangeSet) -> int:
+    """Apply a change set to the dimension and history tables in one transaction.
+
+    Returns the ledger ``load_id`` recorded for the load.
+    """
+    spec = SNAPSHOT_SPECS[changeset.dataset]
+    key, sk, target = spec.natural_key, spec.surrogate_key, spec.target_table
+    tracked = spec.tracked_columns
+    history = history_table(spec)
+    cs = f"read_parquet({_sql_str(str(changeset.path))})"
+    valid_from = changeset.new_downloaded_at
+
+    ensure_ledger(conn)
+    ensure_history(conn, spec)
+    conn.execute("BEGIN TRANSACTION")
+    try:
+        # Resolve surrogate keys: existing ones for updates/deletes, the historical
+        # one for keys coming back after a delete, fresh ones for new inserts
+        conn.execute(f"""
+            CREATE TEMP TABLE _changes AS
+            SELECT c.*,
+                   coalesce(d.{sk}, h.{sk}, base.n + row_number() OVER (
+                       PARTITION BY coalesce(d.{sk}, h.{sk}) IS NULL ORDER BY c.{key}
+                   )) AS {sk}
+            FROM {cs} c
+            LEFT JOIN {target} d ON d.{key} = c.{key}
+            LEFT JOIN (
+                SELECT {key}, max({sk}) AS {sk} FROM {history} GROUP BY {key}
+            ) h ON h.{key} = c.{key}
+            CROSS JOIN (
+                SELECT greatest(
+                    (SELECT coalesce(max({sk}), 0) FROM {target}),
+                    (SELECT coalesce(max({sk}), 0) FROM {history})
+                ) AS n
+            ) base
+        """)
+
+        # History: close the current version of every updated/deleted key...
+        conn.execute(f"""
+            UPDATE {history} SET valid_to = ?::TIMESTAMPTZ, is_current = false
+            WHERE is_current
+              AND {key} IN (SELECT {key} FROM _changes WHERE op IN ('update', 'delete'))
+        """, [valid_from])
+        # ...and open a new one for every key that still exists (deletes get a tombstone)
+        conn.execute(f"""
+            INSERT INTO {history}
+            SELECT {sk}, {key}, {', '.join(tracked)}, op, ?, ?::TIMESTAMPTZ, NULL, op <> 'delete'
+            FROM _changes
+        """, [changeset.new_vintage, valid_from])
+
+        # Dimension
+        conn.execute(f"DELETE FROM {target} WHERE {key} IN "
+                     f"(SELECT {key} FROM _changes WHERE op = 'delete')")
+        conn.execute(f"""
+            UPDATE {target} t SET {', '.join(f'{c} = c.{c}' for c in tracked)}
+            FROM _changes c
+            WHERE c.op = 'update' AND t.{key} = c.{key}
+        """)
+        conn.execute(f"""
+            INSERT INTO {target} ({sk}, {key}, {', '.join(tracked)})
+            SELECT {sk}, {key}, {', '.join(tracked)}
+            FROM _changes WHERE op = 'insert'
+        """)
+        conn.execute("DROP TABLE _changes")
+
+        load_id = record_load(
+            conn,
+            spec.dataset,
+            target,
+            rows_affected=sum(changeset.counts.values()),
+            source_vintage=changeset.new_vintage,
+        )
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    logger.info("Applied %s change set to %s (load_id=%d)", spec.dataset, target, load_id)
+    return load_id
+
+
+def last_applied_vintage(conn: duckdb.DuckDBPyConnection, dataset: str) -> str | None:
+    """Return the vintage id of the last change set applied for ``dataset``."""
+    ensure_ledger(conn)
+    row = conn.execute(
+        f"SELECT source_vintage FROM {LOAD_LEDGER_TABLE} "
+        "WHERE dataset = ? ORDER BY load_id DESC LIMIT 1",
+        [dataset],
+    ).fetchone()
+    return row[0] if row else None
+
+
+# ---------------------------------------------------------------------------
+# CLI entry point
+# ---------------------------------------------------------------------------
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Diff registry vintages and apply the changes")
+    parser.add_argument("dataset", choices=list(SNAPSHOT_SPECS.keys()))
+    parser.add_argument("--apply", action="store_true", help="Apply the change set to DuckDB")
+    parser.add_argument("--memory-limit", default="1GB", help="DuckDB memory limit for the diff")
+    args = parser.parse_args()
+
+    spec = SNAPSHOT_SPECS[args.dataset]
+    dataset_dir = get_raw_dir() / args.dataset
+    live = vintage_of(dataset_dir)
+    if live is None:
+        print(f"No downloaded files for {args.dataset}; run etl.download first.")
+        return
+
+    conn = duckdb.connect(str(get_settings().duckdb_path))
+    try:
+        applied = last_applied_vintage(conn, args.dataset)
+        if applied == live.vintage_id:
+            print(f"{args.dataset} is up to date (vintage {applied}).")
+            return
+        known = {v.vintage_id: v.path for v in list_vintages(dataset_dir)}
+        if applied is not None and applied not in known:
+            raise SystemExit(f"Last applied vintage {applied} is no longer archived.")
+        old = known.get(applied) if applied else None
+
+        out_name = f"changes_{applied or 'initial'}__{live.vintage_id}.parquet"
+        out = dataset_dir / VINTAGES_DIR / out_name
+        changeset = diff_vintages(spec, old, dataset_dir, out, memory_limit=args.memory_limit)
+        print(f"{args.dataset}: {applied or '(empty)'} -> {live.vintage_id}")
+        for op, n in changeset.counts.items():
+            print(f"  {op:8s} {n:>10,}")
+        if args.apply:
+            apply_changeset(conn, changeset)
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
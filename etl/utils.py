@@ -2,13 +2,21 @@
 
 from __future__ import annotations
 
+import functools
 import hashlib
 import logging
 import os
+from dataclasses import dataclass
 from pathlib import Path
+from typing import TYPE_CHECKING
 
-import httpx
-from dotenv import load_dotenv
+if TYPE_CHECKING:
+    import duckdb
+    import httpx
+    import pyarrow as pa
+
+# Heavy third-party modules (httpx, dotenv) are imported inside the functions that
+# need them, so metadata-only entry points such as ``etl.download --list`` start fast.
 
 
 def setup_logging(name: str, level: int = logging.INFO) -> logging.Logger:
@@ -29,10 +37,13 @@ def get_project_root() -> Path:
     return Path(__file__).resolve().parent.parent
 
 
+@functools.cache
 def load_env() -> None:
-    """Load .env file from project root."""
+    """Load .env file from project root (parsed once per process)."""
     env_path = get_project_root() / ".env"
     if env_path.exists():
+        from dotenv import load_dotenv
+
         load_dotenv(env_path)
 
 
@@ -42,9 +53,43 @@ def get_config(key: str, default: str = "") -> str:
     return os.getenv(key, default)
 
 
+@dataclass(frozen=True)
+class Settings:
+    """Typed ETL settings, mirroring .env.example. Paths are absolute."""
+
+    datagouv_api_base: str
+    data_raw_dir: Path
+    data_processed_dir: Path
+    download_timeout_seconds: float
+    download_max_retries: int
+    duckdb_path: Path
+
+    @classmethod
+    def from_env(cls) -> Settings:
+        root = get_project_root()
+        return cls(
+            datagouv_api_base=get_config("DATAGOUV_API_BASE", "https://www.data.gouv.fr/api/1"),
+            data_raw_dir=root / get_config("DATA_RAW_DIR", "data/raw"),
+            data_processed_dir=root / get_config("DATA_PROCESSED_DIR", "data/processed"),
+            download_timeout_seconds=float(get_config("DOWNLOAD_TIMEOUT_SECONDS", "600")),
+            download_max_retries=int(get_config("DOWNLOAD_MAX_RETRIES", "3")),
+            duckdb_path=root / get_config("DUCKDB_PATH", "data/processed/pharmascope.duckdb"),
+        )
+
+
+@functools.cache
+def get_settings() -> Settings:
+    """Return the process-wide settings, built on first use.
+
+    Call ``get_settings.cache_clear()`` (and ``load_env.cache_clear()``) to
+    re-read the environment, e.g. in tests.
+    """
+    return Settings.from_env()
+
+
 def get_raw_dir() -> Path:
     """Return the raw data directory, creating it if needed."""
-    raw_dir = get_project_root() / get_config("DATA_RAW_DIR", "data/raw")
+    raw_dir = get_settings().data_raw_dir
     raw_dir.mkdir(parents=True, exist_ok=True)
     return raw_dir
 
@@ -60,8 +105,10 @@ def sha256_file(path: Path) -> str:
 
 def make_http_client(timeout: float | None = None) -> httpx.AsyncClient:
     """Create a configured async HTTP client."""
+    import httpx
+
     if timeout is None:
-        timeout = float(get_config("DOWNLOAD_TIMEOUT_SECONDS", "600"))
+        timeout = get_settings().download_timeout_seconds
     return httpx.AsyncClient(
         timeout=httpx.Timeout(timeout, connect=30.0),
         follow_redirects=True,
@@ -74,3 +121,21 @@ def make_http_client(timeout: float | None = None) -> httpx.AsyncClient:
 def sanitize_filename(name: str) -> str:
     """Clean a string for use as a filename."""
     return "".join(c if c.isalnum() or c in ".-_" else "_" for c in name)
+
+
+def arrow_table(result: duckdb.DuckDBPyConnection) -> pa.Table:
+    """Fetch a DuckDB result as an Arrow table.
+
+    duckdb >= 1.4 renamed ``fetch_arrow_table`` to ``to_arrow_table`` and the old
+    name emits a DeprecationWarning; use whichever this version provides.
+    """
+    fetch = getattr(result, "to_arrow_table", None) or result.fetch_arrow_table
+    return fetch()
+
+
+def arrow_reader(
+    result: duckdb.DuckDBPyConnection, batch_rows: int = 1_000_000
+) -> pa.RecordBatchReader:
+    """Stream a DuckDB result as an Arrow record batch reader (see ``arrow_table``)."""
+    fetch = getattr(result, "to_arrow_reader", None) or result.fetch_record_batch
+    return fetch(batch_rows)
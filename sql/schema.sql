@@ -142,6 +142,7 @@ CREATE TABLE IF NOT EXISTS fact_prescriptions (
     hcp_profession_code VARCHAR(10),               -- Prescriber profession code
     age_group           VARCHAR(10),               -- Tranche d'âge
     sex                 SMALLINT,                  -- 1=M, 2=F, 9=Unknown
+    ben_reg             VARCHAR(2),                -- Beneficiary region (BEN_REG, pre-2016 codes)
     annee               SMALLINT NOT NULL,
     -- Measures
     nb_boites           BIGINT,                    -- Boxes dispensed
@@ -3,7 +3,7 @@
 from pathlib import Path
 
 from etl.config import BDPM_FILES, DATASETS
-from etl.download import _derive_filename, _should_skip
+from etl.download import _derive_filename, _drop_superseded, _should_skip
 from etl.utils import get_project_root, sanitize_filename, sha256_file
 
 
@@ -95,3 +95,13 @@ def test_sha256_file(tmp_path):
 def test_project_root():
     root = get_project_root()
     assert (root / "pyproject.toml").exists()
+
+
+def test_drop_superseded_removes_replaced_extracts(tmp_path):
+    old = tmp_path / "etalab-cs1100507-stock-20260101-0336.csv"
+    new = tmp_path / "etalab-cs1100507-stock-20260201-0336.csv"
+    old.write_text("old")
+    new.write_text("new")
+    _drop_superseded(tmp_path, {old.name: {}, new.name: {}}, {new.name: {}})
+    assert not old.exists()
+    assert new.exists()
@@ -0,0 +1,120 @@
+"""Tests for the commune-history-aware geography resolver."""
+
+from pathlib import Path
+
+import duckdb
+import pyarrow as pa
+import pytest
+
+from etl.geography import (
+    GeographyResolver,
+    dim_geography_table,
+    encode_commune_code,
+    encode_commune_codes,
+    resolve_region_codes,
+)
+
+V_COMMUNE = """TYPECOM,COM,REG,DEP,CTCD,ARR,TNCC,NCC,NCCENR,LIBELLE,CAN,COMPARENT
+COM,01001,84,01,01D,012,5,ANNECY,Annecy,Annecy,0108,
+COMD,01001,,,,,5,ANNECY,Annecy,Annecy,,01001
+COMD,01002,,,,,1,ANNECY LE VIEUX,Annecy-le-Vieux,Annecy-le-Vieux,,01001
+COM,01004,84,01,01D,012,0,BOURG,Bourg,Bourg,0108,
+COM,01005,84,01,01D,012,0,VILLARS,Villars,Villars,0108,
+COM,2A004,94,2A,2AD,2A1,0,AJACCIO,Ajaccio,Ajaccio,2A98,
+COM,75056,11,75,75C,751,0,PARIS,Paris,Paris,7598,
+ARM,75101,,,,,0,PARIS 1ER ARRONDISSEMENT,Paris 1er Arrondissement,Paris 1er Arrondissement,,75056
+"""
+
+# 01003 -> 01002 (2016), 01002 -> 01001 (2019): two-hop chain
+# 01004 -> 01005 (2017), then 01004 re-established out of 01005 (2021)
+V_MVT_COMMUNE = (
+    "MOD,DATE_EFF,TYPECOM_AV,COM_AV,TNCC_AV,NCC_AV,NCCENR_AV,LIBELLE_AV,"
+    "TYPECOM_AP,COM_AP,TNCC_AP,NCC_AP,NCCENR_AP,LIBELLE_AP\n"
+) + """31,2016-01-01,COM,01003,0,X,X,X,COM,01002,1,Y,Y,Y
+31,2016-01-01,COM,01002,1,Y,Y,Y,COM,01002,1,Y,Y,Y
+32,2019-01-01,COM,01002,1,Y,Y,Y,COM,01001,5,A,A,A
+32,2019-01-01,COM,01002,1,Y,Y,Y,COMD,01002,1,Y,Y,Y
+32,2019-01-01,COM,01001,5,A,A,A,COM,01001,5,A,A,A
+31,2017-01-01,COM,01004,0,B,B,B,COM,01005,0,V,V,V
+21,2021-01-01,COM,01005,0,V,V,V,COM,01005,0,V,V,V
+21,2021-01-01,COM,01005,0,V,V,V,COM,01004,0,B,B,B
+"""
+
+V_DEPARTEMENT = """DEP,REG,CHEFLIEU,TNCC,NCC,NCCENR,LIBELLE
+01,84,01053,5,AIN,Ain,Ain
+2A,94,2A004,3,CORSE DU SUD,Corse-du-Sud,Corse-du-Sud
+75,11,75056,0,PARIS,Paris,Paris
+"""
+
+V_REGION = """REG,CHEFLIEU,TNCC,NCC,NCCENR,LIBELLE
+11,75056,1,ILE DE FRANCE,Île-de-France,Île-de-France
+84,69123,1,AUVERGNE RHONE ALPES,Auvergne-Rhône-Alpes,Auvergne-Rhône-Alpes
+94,2A004,0,CORSE,Corse,Corse
+"""
+
+
+@pytest.fixture
+def cog_dir(tmp_path) -> Path:
+    d = tmp_path / "insee_cog"
+    d.mkdir()
+    (d / "v_commune_2025.csv").write_text(V_COMMUNE, encoding="utf-8")
+    (d / "v_mvt_commune_2025.csv").write_text(V_MVT_COMMUNE, encoding="utf-8")
+    (d / "v_departement_2025.csv").write_text(V_DEPARTEMENT, encoding="utf-8")
+    (d / "v_region_2025.csv").write_text(V_REGION, encoding="utf-8")
+    return d
+
+
+def test_encode_commune_code():
+    assert encode_commune_code("01001") == 1001
+    assert encode_commune_code("2A004") == 100_004
+    assert encode_commune_code("2B033") == 101_033
+    assert encode_commune_code("97411") == 97_411
+    assert encode_commune_code("1001") is None
+    codes = pa.array(["01001", "2B033", " 75056", None, "ABCDE"])
+    assert encode_commune_codes(codes).to_pylist() == [1001, 101_033, 75_056, None, None]
+
+
+def test_resolver_follows_commune_history(cog_dir):
+    resolver = GeographyResolver.from_cog(cog_dir)
+    assert resolver.resolve("01001") == "01001"
+    assert resolver.resolve("01002") == "01001"  # merged into a commune nouvelle
+    assert resolver.resolve("01003") == "01001"  # two merges
+    assert resolver.resolve("01004") == "01004"  # re-established
+    assert resolver.resolve("01005") == "01005"  # still exists after the split
+    assert resolver.resolve("75101") == "75101"  # arrondissements are dim rows
+    assert resolver.resolve("99999") is None
+
+
+def test_geo_keys_vectorized(cog_dir):
+    resolver = GeographyResolver.from_cog(cog_dir)
+    codes = pa.array(["01003", "2A004", "01002", None, "99999", "75101"])
+    assert resolver.geo_keys(codes).to_pylist() == [1001, 100_004, 1001, None, None, 75_101]
+
+
+def test_register_for_duckdb_join(cog_dir):
+    resolver = GeographyResolver.from_cog(cog_dir)
+    conn = duckdb.connect(":memory:")
+    resolver.register(conn)
+    facts = pa.table({"code_commune": ["01003", "01004", "99999"]})
+    conn.register("facts", facts)
+    rows = conn.execute(
+        "SELECT f.code_commune, m.geo_key FROM facts f "
+        "LEFT JOIN geo_commune_map m USING (code_commune) ORDER BY 1"
+    ).fetchall()
+    assert rows == [("01003", 1001), ("01004", 1004), ("99999", None)]
+
+
+def test_resolve_region_codes():
+    codes = pa.array(["21", "44", "93", "91", None])
+    assert resolve_region_codes(codes).to_pylist() == ["44", "44", "93", "76", None]
+
+
+def test_dim_geography_table(cog_dir):
+    table = dim_geography_table(cog_dir)
+    rows = {r["code_commune_insee"]: r for r in table.to_pylist()}
+    assert set(rows) == {"01001", "01004", "01005", "2A004", "75056", "75101"}
+    assert rows["2A004"]["geo_key"] == 100_004
+    assert rows["2A004"]["nom_region"] == "Corse"
+    # Arrondissements inherit département and région from their commune
+    assert rows["75101"]["code_departement"] == "75"
+    assert rows["75101"]["nom_region"] == "Île-de-France"
@@ -0,0 +1,148 @@
+"""Tests for the HCP engagement profile store."""
+
+import time
+from pathlib import Path
+
+import duckdb
+import pyarrow as pa
+import pytest
+
+from etl.ledger import record_load
+from etl.profiles import ProfileStore, build_profiles, record_payment_rpps, refresh_profiles
+
+SCHEMA_PATH = Path(__file__).resolve().parent.parent / "sql" / "schema.sql"
+
+
+def _payment(key: int, rpps: str, lab: int, categorie: str, annee: int, montant: float,
+             source_file: str = "ts_2023.csv") -> tuple:
+    return (key, rpps, lab, categorie, annee, montant, source_file)
+
+
+def _insert_payments(conn: duckdb.DuckDBPyConnection, rows: list[tuple]) -> None:
+    conn.executemany(
+        "INSERT INTO fact_pharma_payments "
+        "(payment_key, numero_rpps, lab_key, categorie, annee, montant_ttc, source_file) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?)",
+        rows,
+    )
+
+
+@pytest.fixture
+def warehouse() -> duckdb.DuckDBPyConnection:
+    conn = duckdb.connect(":memory:")
+    conn.execute(SCHEMA_PATH.read_text(encoding="utf-8"))
+    conn.execute(
+        "INSERT INTO dim_geography (geo_key, code_commune_insee, code_departement, "
+        "code_region) VALUES (75056, '75056', '75', '11'), (69123, '69123', '69', '84')"
+    )
+    conn.execute(
+        "INSERT INTO dim_hcp (hcp_key, numero_rpps, nom_exercice, code_savoir_faire, "
+        "code_mode_exercice, code_commune_exercice, code_departement_exercice) VALUES "
+        "(1, '10000000001', 'MARTIN', 'SM26', 'L', '75056', '75'), "
+        "(2, '10000000002', 'DURAND', 'SM54', 'L', '69123', '69'), "
+        "(3, '10000000003', 'PETIT', 'SM04', 'S', '75056', '75')"
+    )
+    _insert_payments(conn, [
+        _payment(1, "10000000001", 1, "Avantage", 2022, 100.0),
+        _payment(2, "10000000001", 1, "Avantage", 2023, 50.0),
+        _payment(3, "10000000001", 2, "Convention", 2023, 300.0),
+        _payment(4, "10000000002", 1, "Avantage", 2023, 20.0),
+        _payment(5, "10000000003", 3, "Rémunération", 2023, 1000.0),
+    ])
+    conn.execute(
+        "INSERT INTO fact_prescriptions (prescription_key, time_key, ben_reg, "
+        "hcp_profession_code, annee, nb_boites, montant_rembourse) VALUES "
+        "(1, 202300, '11', '01', 2023, 10, 99.0), "   # médecine générale, Île-de-France
+        "(2, 202300, '11', '3', 2023, 4, 60.0), "     # cardiologie (libérale)
+        "(3, 202300, '11', '90', 2023, 7, 80.0), "    # salariés
+        "(4, 202300, '82', '1', 2023, 5, 40.0)"       # pre-2016 Rhône-Alpes
+    )
+    return conn
+
+
+def test_build_profiles(warehouse):
+    build_profiles(warehouse)
+    store = ProfileStore.from_warehouse(warehouse)
+    assert len(store) == 3
+
+    profile = store.get("10000000001")
+    assert float(profile["montant_ttc_total"]) == 450.0
+    assert profile["nb_labs"] == 2
+    assert (profile["code_departement"], profile["code_region"]) == ("75", "11")
+    assert (profile["first_annee"], profile["last_annee"]) == (2022, 2023)
+    assert len(profile["payments"]) == 3
+    assert profile["psp_spe"] == "1"
+    assert [c["nb_boites"] for c in profile["prescribing_context"]] == [10]
+    # A salaried cardiologist is reported by Open Medic under PSP_SPE 90
+    assert [c["nb_boites"] for c in store.get("10000000003")["prescribing_context"]] == [7]
+    # Pre-2016 BEN_REG 82 (Rhône-Alpes) counts for Auvergne-Rhône-Alpes (84)
+    lyon = store.get("10000000002")["prescribing_context"]
+    assert [(c["code_region"], c["nb_boites"]) for c in lyon] == [("84", 5)]
+    assert store.get("99999999999") is None
+
+
+def test_top_n_by_departement(warehouse):
+    build_profiles(warehouse)
+    store = ProfileStore.from_warehouse(warehouse)
+    top = store.top_n("75", n=1)
+    assert top.column("numero_rpps").to_pylist() == ["10000000003"]
+    assert store.top_n(n=10).num_rows == 3
+
+
+def test_refresh_recomputes_only_declared_rpps(warehouse):
+    build_profiles(warehouse)
+    # Reload of the single Transparence Santé file: one payment corrected away,
+    # one added. Both the removed and the new row's RPPS are declared.
+    warehouse.execute("DELETE FROM fact_pharma_payments WHERE payment_key = 5")
+    _insert_payments(
+        warehouse, [_payment(6, "10000000002", 2, "Avantage", 2024, 5.0, "ts_declaration.csv")]
+    )
+    load_id = record_load(warehouse, "transparence_sante", "fact_pharma_payments", 2,
+                          "ts_declaration.csv")
+    record_payment_rpps(warehouse, load_id, ["10000000003", "10000000002"])
+    # Tamper with another profile: an incremental refresh must leave it alone
+    warehouse.execute("UPDATE hcp_profile SET nb_labs = 99 WHERE numero_rpps = '10000000001'")
+
+    assert refresh_profiles(warehouse) is not None
+    store = ProfileStore.from_warehouse(warehouse)
+    assert store.get("10000000002")["nb_labs"] == 2
+    assert store.get("10000000002")["last_annee"] == 2024
+    assert store.get("10000000003") is None  # no payments left
+    assert store.get("10000000001")["nb_labs"] == 99
+    assert warehouse.execute("SELECT count(*) FROM hcp_profile_pending_rpps").fetchone()[0] == 0
+
+    assert refresh_profiles(warehouse) is None  # nothing new in the ledger
+
+
+def test_refresh_of_undeclared_payment_load_falls_back_to_full_build(warehouse):
+    build_profiles(warehouse)
+    warehouse.execute("UPDATE hcp_profile SET nb_labs = 99 WHERE numero_rpps = '10000000001'")
+    record_load(warehouse, "transparence_sante", "fact_pharma_payments", 0, "ts_declaration.csv")
+    refresh_profiles(warehouse)
+    assert ProfileStore.from_warehouse(warehouse).get("10000000001")["nb_labs"] == 2
+
+
+def test_single_hcp_lookup_under_a_millisecond():
+    n = 200_000
+    rpps = [f"1{i:010d}" for i in range(n)]
+    profiles = pa.table({
+        "numero_rpps": rpps,
+        "code_departement": ["75"] * n,
+        "code_region": ["11"] * n,
+        "psp_spe": ["1"] * n,
+        "montant_ttc_total": [float(i) for i in range(n)],
+    })
+    payments = pa.table({
+        "numero_rpps": [r for r in rpps for _ in range(3)],
+        "annee": [2021, 2022, 2023] * n,
+        "montant_ttc": [1.0] * (3 * n),
+    })
+    context = pa.table({"code_region": ["11"], "hcp_profession_code": ["1"]})
+    store = ProfileStore(profiles, payments, context)
+
+    probes = rpps[::1000]
+    start = time.perf_counter()
+    for key in probes:
+        assert store.get(key) is not None
+    per_lookup_ms = (time.perf_counter() - start) * 1000 / len(probes)
+    assert per_lookup_ms < 1.0, f"{per_lookup_ms:.3f} ms per lookup"
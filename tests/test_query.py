@@ -0,0 +1,195 @@
+"""Tests for the read-only query service and its result cache."""
+
+import subprocess
+import sys
+from pathlib import Path
+
+import duckdb
+import pyarrow as pa
+import pytest
+
+from etl.ledger import ledger_version, record_load
+from etl.query import QUERIES, QueryService, ResultCache, _parse_param
+
+SCHEMA_PATH = Path(__file__).resolve().parent.parent / "sql" / "schema.sql"
+
+
+def _build_warehouse(db_path: Path) -> None:
+    conn = duckdb.connect(str(db_path))
+    conn.execute(SCHEMA_PATH.read_text(encoding="utf-8"))
+    conn.execute(
+        "INSERT INTO dim_molecule (molecule_key, code_cip13, code_atc, substance_active) VALUES "
+        "(1, '3400930000001', 'C10AA05', 'ATORVASTATINE'), "
+        "(2, '3400930000002', 'C10AA07', 'ROSUVASTATINE'), "
+        "(3, '3400930000003', 'N02BE01', 'PARACETAMOL')"
+    )
+    conn.execute(
+        "INSERT INTO fact_prescriptions "
+        "(prescription_key, time_key, molecule_key, annee, nb_boites, montant_rembourse) VALUES "
+        "(1, 202300, 1, 2023, 10, 100.0), (2, 202300, 2, 2023, 5, 300.0), "
+        "(3, 202300, 3, 2023, 50, 80.0), (4, 202200, 1, 2022, 7, 70.0)"
+    )
+    record_load(conn, "open_medic", "fact_prescriptions", rows_affected=4)
+    conn.close()
+
+
+@pytest.fixture
+def warehouse(tmp_path) -> Path:
+    db_path = tmp_path / "wh.duckdb"
+    _build_warehouse(db_path)
+    return db_path
+
+
+def test_named_queries_declare_their_params():
+    for name, q in QUERIES.items():
+        assert q.name == name
+        for param in (*q.params, *q.defaults):
+            assert f"${param}" in q.sql, f"{name} does not use ${param}"
+
+
+def test_ledger_version_empty_database():
+    conn = duckdb.connect(":memory:")
+    assert ledger_version(conn) == 0
+    assert record_load(conn, "rpps", "dim_hcp") == 1
+    assert record_load(conn, "rpps", "dim_hcp") == 2
+    assert ledger_version(conn) == 2
+
+
+def test_run_streams_record_batches(warehouse):
+    with QueryService(warehouse, pool_size=2) as service:
+        reader = service.run("top_molecules_atc_year", atc_prefix="C10", annee=2023)
+        assert isinstance(reader, pa.RecordBatchReader)
+        table = reader.read_all()
+    assert table.column("substance_active").to_pylist() == ["ROSUVASTATINE", "ATORVASTATINE"]
+
+
+def test_run_caches_results(warehouse):
+    with QueryService(warehouse, pool_size=1) as service:
+        first = service.run_table("top_molecules_atc_year", atc_prefix="C10", annee=2023)
+        assert len(service.cache) == 1
+        second = service.run_table("top_molecules_atc_year", atc_prefix="C10", annee=2023)
+        assert first.equals(second)
+        service.run_table("top_molecules_atc_year", atc_prefix="C10", annee=2022)
+        assert len(service.cache) == 2
+
+
+def test_partially_read_stream_is_not_cached(warehouse):
+    with QueryService(warehouse, pool_size=1, batch_rows=1) as service:
+        reader = service.run("top_molecules_atc_year", atc_prefix="C10", annee=2023)
+        reader.read_next_batch()
+        del reader
+        assert len(service.cache) == 0
+        # Dropping the reader early hands its connection back to the pool
+        assert service.run_table("prescriptions_departement_year", annee=2023).num_rows == 0
+
+
+def test_stream_outliving_a_ledger_bump_is_not_cached(warehouse):
+    with QueryService(warehouse, batch_rows=1) as service:
+        reader = service.run("top_molecules_atc_year", atc_prefix="C10", annee=2023)
+        # Another query observes a newer ledger while the first stream is in flight
+        newer = duckdb.connect(":memory:")
+        for _ in range(2):
+            record_load(newer, "open_medic", "fact_prescriptions")
+        assert service._check_version(newer) == 2
+        assert reader.read_all().num_rows == 2
+        assert len(service.cache) == 0
+
+
+_WRITER = """
+import sys
+import duckdb
+from etl.ledger import record_load
+
+conn = duckdb.connect(sys.argv[1])
+conn.execute("UPDATE fact_prescriptions SET montant_rembourse = 1000 WHERE molecule_key = 1")
+record_load(conn, "open_medic", "fact_prescriptions", rows_affected=1)
+conn.close()
+"""
+
+_LOCK_HOLDER = """
+import sys
+import duckdb
+
+conn = duckdb.connect(sys.argv[1])
+print("locked", flush=True)
+sys.stdin.readline()
+"""
+
+
+def _python(script: str, *args: str, **kwargs) -> subprocess.Popen:
+    return subprocess.Popen(
+        [sys.executable, "-c", script, *args],
+        cwd=Path(__file__).resolve().parent.parent,
+        text=True,
+        **kwargs,
+    )
+
+
+def test_ledger_version_change_invalidates_cache(warehouse):
+    with QueryService(warehouse) as service:
+        first = service.run_table("top_molecules_atc_year", atc_prefix="C10", annee=2023)
+        service.run_table("top_molecules_atc_year", atc_prefix="C10", annee=2022)
+        assert len(service.cache) == 2
+        assert first.column("substance_active")[0].as_py() == "ROSUVASTATINE"
+
+        # A loader in another process writes while the service is up
+        assert _python(_WRITER, str(warehouse)).wait(timeout=60) == 0
+
+        table = service.run_table("top_molecules_atc_year", atc_prefix="C10", annee=2023)
+        assert table.column("substance_active")[0].as_py() == "ATORVASTATINE"
+        assert [key[-1] for key in service.cache._entries] == [2]
+
+
+def test_cached_results_served_while_writer_holds_lock(warehouse):
+    with QueryService(warehouse) as service:
+        cached = service.run_table("top_molecules_atc_year", atc_prefix="C10", annee=2023)
+        holder = _python(_LOCK_HOLDER, str(warehouse),
+                         stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        try:
+            assert holder.stdout.readline().strip() == "locked"
+            again = service.run_table("top_molecules_atc_year", atc_prefix="C10", annee=2023)
+            assert again.equals(cached)
+            with pytest.raises(duckdb.IOException):
+                service.run_table("top_molecules_atc_year", atc_prefix="C10", annee=2022)
+        finally:
+            holder.communicate("\n", timeout=60)
+
+
+def test_run_rejects_bad_params(warehouse):
+    with QueryService(warehouse) as service:
+        with pytest.raises(KeyError):
+            service.run("no_such_query")
+        with pytest.raises(ValueError, match="missing"):
+            service.run("top_molecules_atc_year", atc_prefix="C10")
+        with pytest.raises(ValueError, match="unknown"):
+            service.run("prescriptions_departement_year", annee=2023, foo=1)
+
+
+def test_result_cache_evicts_least_recently_used():
+    batch = pa.record_batch({"x": pa.array(range(100), type=pa.int64())})
+    cache = ResultCache(max_bytes=batch.nbytes * 2)
+    cache.put(("a",), batch.schema, [batch])
+    cache.put(("b",), batch.schema, [batch])
+    assert cache.get(("a",)) is not None  # "a" becomes most recently used
+    cache.put(("c",), batch.schema, [batch])
+    assert cache.get(("b",)) is None
+    assert cache.get(("a",)) is not None
+    assert cache.get(("c",)) is not None
+    assert cache.nbytes == batch.nbytes * 2
+
+
+def test_result_cache_skips_oversized_entries():
+    batch = pa.record_batch({"x": pa.array(range(100), type=pa.int64())})
+    cache = ResultCache(max_bytes=batch.nbytes - 1)
+    cache.put(("a",), batch.schema, [batch])
+    assert len(cache) == 0
+
+
+def test_cli_params_follow_declared_types():
+    query = QUERIES["payments_lab_departement"]
+    assert _parse_param(query, "code_departement=01") == ("code_departement", "01")
+    assert _parse_param(query, "code_departement=2A") == ("code_departement", "2A")
+    assert _parse_param(query, "annee=2023") == ("annee", 2023)
+    assert _parse_param(query, "limit=5") == ("limit", 5)
+    with pytest.raises(ValueError, match="annee"):
+        _parse_param(query, "annee=deux-mille")
@@ -78,6 +78,7 @@ def test_fact_prescriptions_columns():
     assert "nb_boites" in col_names
     assert "montant_rembourse" in col_names
     assert "annee" in col_names
+    assert "ben_reg" in col_names
 
 
 def test_fact_pharma_payments_columns():
@@ -0,0 +1,257 @@
+"""Tests for the RPPS/FINESS snapshot diff engine."""
+
+import json
+from pathlib import Path
+
+import duckdb
+import pytest
+
+from etl.ledger import ledger_version
+from etl.snapshot import (
+    SNAPSHOT_SPECS,
+    apply_changeset,
+    archive_vintage,
+    diff_vintages,
+    last_applied_vintage,
+    list_vintages,
+    vintage_of,
+)
+from etl.utils import sha256_file
+
+SCHEMA_PATH = Path(__file__).resolve().parent.parent / "sql" / "schema.sql"
+
+RPPS_HEADER = (
+    "Identifiant PP|Nom d'exercice|Prénom d'exercice|Code profession|Libellé profession|"
+    "Code catégorie professionnelle|Libellé catégorie professionnelle|Code savoir-faire|"
+    "Libellé savoir-faire|Code mode exercice|Libellé mode exercice|"
+    "Code commune (coord. structure)"
+)
+RPPS_FILE = "PS_LibreAcces_Personne_activite.txt"
+
+
+def _rpps_row(rpps: str, nom: str, sf: str, commune: str) -> str:
+    return f"{rpps}|{nom}|JEAN|10|Médecin|C|Civil|{sf}|Spécialité {sf}|L|Libéral|{commune}"
+
+
+def _write_vintage(dataset_dir: Path, rows: list[str], downloaded_at: str) -> None:
+    dataset_dir.mkdir(parents=True, exist_ok=True)
+    path = dataset_dir / RPPS_FILE
+    path.write_text("\n".join([RPPS_HEADER, *rows]) + "\n", encoding="utf-8")
+    meta = {
+        "dataset": "rpps",
+        "files": {RPPS_FILE: {"sha256": sha256_file(path), "downloaded_at": downloaded_at}},
+    }
+    (dataset_dir / "_metadata.json").write_text(json.dumps(meta), encoding="utf-8")
+
+
+@pytest.fixture
+def rpps_dir(tmp_path) -> Path:
+    d = tmp_path / "rpps"
+    _write_vintage(
+        d,
+        [
+            _rpps_row("10000000001", "MARTIN", "SM26", "75056"),
+            _rpps_row("10000000001", "MARTIN", "SM54", "75056"),  # second activity, same HCP
+            _rpps_row("10000000002", "DURAND", "SM54", "69123"),
+            _rpps_row("10000000003", "PETIT", "SM26", "13055"),
+        ],
+        "2026-01-05T10:00:00+00:00",
+    )
+    return d
+
+
+def _move_to_next_vintage(rpps_dir: Path) -> None:
+    """Re-download: archive, then overwrite with the next extract."""
+    archive_vintage(rpps_dir)
+    (rpps_dir / RPPS_FILE).unlink()
+    _write_vintage(
+        rpps_dir,
+        [
+            _rpps_row("10000000001", "MARTIN", "SM26", "75056"),  # unchanged
+            _rpps_row("10000000002", "DURAND", "SM54", "69381"),  # moved commune
+            _rpps_row("10000000004", "ROUX", "SM40", "33063"),    # new
+        ],                                                          # 3 disappeared
+        "2026-02-05T10:00:00+00:00",
+    )
+
+
+def _warehouse() -> duckdb.DuckDBPyConnection:
+    conn = duckdb.connect(":memory:")
+    conn.execute(SCHEMA_PATH.read_text(encoding="utf-8"))
+    return conn
+
+
+def test_snapshot_specs_target_snapshot_datasets():
+    for name, spec in SNAPSHOT_SPECS.items():
+        assert spec.dataset == name
+        assert spec.natural_key in spec.columns
+        assert spec.header or spec.raw_names
+
+
+def test_rpps_departement_derived_from_commune():
+    expr = SNAPSHOT_SPECS["rpps"].columns["code_departement_exercice"]
+    codes = ["75056", "2A004", "97411", "98818", "", None]
+    rows = duckdb.execute(
+        f'SELECT {expr} FROM unnest(?) t("Code commune (coord. structure)")', [codes]
+    ).fetchall()
+    assert [r[0] for r in rows] == ["75", "2A", "974", "988", None, None]
+
+
+def _finess_row(finess_et: str, commune: str, departement: str, rs: str = "") -> str:
+    fields = [""] * len(SNAPSHOT_SPECS["finess"].raw_names)
+    fields[:4] = ["structureet", finess_et, "970000000", rs or f"ETAB {finess_et}"]
+    fields[12:14] = [commune, departement]
+    return ";".join(fields)
+
+
+def _write_finess(dataset_dir: Path, stamp: str, rows: list[str]) -> None:
+    """Write one dated FINESS extract; metadata lists only it, as a download does."""
+    dataset_dir.mkdir(parents=True, exist_ok=True)
+    path = dataset_dir / f"etalab-cs1100507-stock-{stamp}-0336.csv"
+    path.write_text(
+        "\n".join([f"finess;etalab;96;{stamp}", *rows]) + "\n", encoding="utf-8"
+    )
+    meta = {"files": {path.name: {"sha256": sha256_file(path), "downloaded_at": stamp}}}
+    (dataset_dir / "_metadata.json").write_text(json.dumps(meta), encoding="utf-8")
+
+
+def test_finess_dom_departements_map_to_insee_codes(tmp_path):
+    d = tmp_path / "finess"
+    _write_finess(d, "20260101", [
+        _finess_row("010000024", "004", "01"),
+        _finess_row("2A0000014", "004", "2A"),
+        _finess_row("970100012", "101", "9A"),
+        _finess_row("970400015", "411", "9D"),
+    ])
+    cs = diff_vintages(SNAPSHOT_SPECS["finess"], None, d, tmp_path / "cs.parquet")
+    rows = duckdb.sql(
+        f"SELECT numero_finess_et, code_commune_insee, code_departement "
+        f"FROM read_parquet('{cs.path}') ORDER BY 1"
+    ).fetchall()
+    assert rows == [
+        ("010000024", "01004", "01"),
+        ("2A0000014", "2A004", "2A"),
+        ("970100012", "97101", "971"),
+        ("970400015", "97411", "974"),
+    ]
+
+
+def test_diff_ignores_stale_extract_next_to_the_current_one(tmp_path):
+    d = tmp_path / "finess"
+    _write_finess(d, "20260101", [
+        _finess_row("010000024", "004", "01", "CLINIQUE A"),
+        _finess_row("010000032", "004", "01", "CLINIQUE B"),
+    ])
+    archive_vintage(d)
+    # The January extract stays on disk next to the February one
+    _write_finess(d, "20260201", [_finess_row("010000024", "004", "01", "CLINIQUE A2")])
+    assert len(list(d.glob(SNAPSHOT_SPECS["finess"].file_glob))) == 2
+
+    [old] = list_vintages(d)
+    assert [p.name for p in old.path.glob("*.csv")] == [
+        "etalab-cs1100507-stock-20260101-0336.csv"
+    ]
+    cs = diff_vintages(SNAPSHOT_SPECS["finess"], old.path, d, tmp_path / "cs.parquet")
+    assert cs.counts == {"insert": 0, "update": 1, "delete": 1}
+
+
+def test_vintage_id_is_stable_and_content_addressed(rpps_dir):
+    v = vintage_of(rpps_dir)
+    assert v.vintage_id.startswith("20260105T100000_")
+    assert vintage_of(rpps_dir) == v
+
+
+def test_archive_vintage_is_idempotent(rpps_dir):
+    first = archive_vintage(rpps_dir)
+    second = archive_vintage(rpps_dir)
+    assert first.vintage_id == second.vintage_id
+    assert len(list_vintages(rpps_dir)) == 1
+    assert (first.path / RPPS_FILE).read_bytes() == (rpps_dir / RPPS_FILE).read_bytes()
+
+
+def test_initial_diff_is_all_inserts(rpps_dir, tmp_path):
+    cs = diff_vintages(SNAPSHOT_SPECS["rpps"], None, rpps_dir, tmp_path / "cs.parquet")
+    assert cs.old_vintage is None
+    assert cs.counts == {"insert": 3, "update": 0, "delete": 0}
+
+
+def test_diff_detects_insert_update_delete(rpps_dir, tmp_path):
+    _move_to_next_vintage(rpps_dir)
+    [old] = list_vintages(rpps_dir)
+    cs = diff_vintages(SNAPSHOT_SPECS["rpps"], old.path, rpps_dir, tmp_path / "cs.parquet")
+    assert cs.counts == {"insert": 1, "update": 1, "delete": 1}
+
+    rows = duckdb.sql(
+        f"SELECT op, numero_rpps, changed_columns FROM read_parquet('{cs.path}') ORDER BY 2"
+    ).fetchall()
+    assert rows[0][:2] == ("update", "10000000002")
+    assert rows[0][2] == ["code_commune_exercice"]  # 69123 -> 69381, same département
+    assert rows[1][:2] == ("delete", "10000000003")
+    assert rows[2][:2] == ("insert", "10000000004")
+
+
+def test_apply_changeset_updates_dimension_and_history(rpps_dir, tmp_path):
+    conn = _warehouse()
+    spec = SNAPSHOT_SPECS["rpps"]
+    initial = diff_vintages(spec, None, rpps_dir, tmp_path / "cs0.parquet")
+    apply_changeset(conn, initial)
+    assert conn.execute("SELECT count(*) FROM dim_hcp").fetchone()[0] == 3
+    assert last_applied_vintage(conn, "rpps") == initial.new_vintage
+
+    _move_to_next_vintage(rpps_dir)
+    [old] = list_vintages(rpps_dir)
+    cs = diff_vintages(spec, old.path, rpps_dir, tmp_path / "cs1.parquet")
+    load_id = apply_changeset(conn, cs)
+    assert load_id == ledger_version(conn) == 2
+
+    dim = dict(conn.execute("SELECT numero_rpps, code_commune_exercice FROM dim_hcp").fetchall())
+    assert dim == {"10000000001": "75056", "10000000002": "69381", "10000000004": "33063"}
+    # Surrogate keys of surviving rows are preserved, new rows get fresh ones
+    keys = conn.execute("SELECT hcp_key FROM dim_hcp ORDER BY numero_rpps").fetchall()
+    assert [k[0] for k in keys] == [1, 2, 4]
+    departements = conn.execute(
+        "SELECT code_departement_exercice FROM dim_hcp ORDER BY numero_rpps"
+    ).fetchall()
+    assert [d[0] for d in departements] == ["75", "69", "33"]
+
+    history = conn.execute(
+        "SELECT code_commune_exercice, change_op, is_current, valid_to IS NOT NULL "
+        "FROM dim_hcp_history WHERE numero_rpps = '10000000002' ORDER BY valid_from"
+    ).fetchall()
+    assert history == [("69123", "insert", False, True), ("69381", "update", True, False)]
+    current = conn.execute(
+        "SELECT count(*) FROM dim_hcp_history WHERE is_current"
+    ).fetchone()[0]
+    assert current == 3
+
+
+def test_reinserted_key_gets_its_surrogate_key_back(rpps_dir, tmp_path):
+    conn = _warehouse()
+    spec = SNAPSHOT_SPECS["rpps"]
+    apply_changeset(conn, diff_vintages(spec, None, rpps_dir, tmp_path / "cs0.parquet"))
+    _move_to_next_vintage(rpps_dir)  # 10000000003 disappears
+    old = list_vintages(rpps_dir)[-1]
+    apply_changeset(conn, diff_vintages(spec, old.path, rpps_dir, tmp_path / "cs1.parquet"))
+
+    # ...and comes back in the next extract, next to a brand new RPPS
+    archive_vintage(rpps_dir)
+    (rpps_dir / RPPS_FILE).unlink()
+    _write_vintage(
+        rpps_dir,
+        [
+            _rpps_row("10000000001", "MARTIN", "SM26", "75056"),
+            _rpps_row("10000000002", "DURAND", "SM54", "69381"),
+            _rpps_row("10000000003", "PETIT", "SM26", "13055"),
+            _rpps_row("10000000004", "ROUX", "SM40", "33063"),
+            _rpps_row("10000000005", "BLANC", "SM54", "31555"),
+        ],
+        "2026-03-05T10:00:00+00:00",
+    )
+    old = list_vintages(rpps_dir)[-1]
+    cs = diff_vintages(spec, old.path, rpps_dir, tmp_path / "cs2.parquet")
+    assert cs.counts == {"insert": 2, "update": 0, "delete": 0}
+    apply_changeset(conn, cs)
+
+    keys = dict(conn.execute("SELECT numero_rpps, hcp_key FROM dim_hcp").fetchall())
+    assert keys["10000000003"] == 3
+    assert keys["10000000005"] == 5
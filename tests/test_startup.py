@@ -0,0 +1,85 @@
+"""Startup-time benchmark and settings tests for the etl entry points.
+
+Cron and orchestration invoke ``python -m etl.download --list``,
+``python -m etl.query --list`` and friends many times a day: metadata-only
+commands must not import heavy dependencies.
+"""
+
+import statistics
+import subprocess
+import sys
+import time
+
+import pytest
+
+from etl.utils import Settings, get_project_root, get_settings, load_env
+
+HEAVY_MODULES = {"httpx", "tenacity", "tqdm", "duckdb", "pyarrow", "pandas", "asyncio", "dotenv"}
+
+# Extra wall time allowed over a bare interpreter for a `--list` command
+STARTUP_BUDGET_MS = 80
+
+# Metadata-only commands and a line their output must contain
+LIST_COMMANDS = {
+    "etl.download": "rpps",
+    "etl.query": "top_molecules_atc_year",
+}
+
+
+def _run(*args: str) -> subprocess.CompletedProcess:
+    return subprocess.run(
+        [sys.executable, *args],
+        capture_output=True,
+        text=True,
+        check=True,
+        cwd=get_project_root(),
+    )
+
+
+def _median_ms(*args: str, runs: int = 5) -> float:
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        _run(*args)
+        timings.append((time.perf_counter() - start) * 1000)
+    return statistics.median(timings)
+
+
+@pytest.mark.parametrize("module", LIST_COMMANDS)
+def test_list_does_not_import_heavy_modules(module):
+    proc = _run("-X", "importtime", "-m", module, "--list")
+    imported = {line.rsplit("|", 1)[-1].strip() for line in proc.stderr.splitlines()}
+    top_level = {name.split(".")[0] for name in imported}
+    assert not (top_level & HEAVY_MODULES), sorted(top_level & HEAVY_MODULES)
+    assert LIST_COMMANDS[module] in proc.stdout
+
+
+@pytest.mark.parametrize("module", LIST_COMMANDS)
+def test_list_startup_budget(module):
+    baseline = _median_ms("-c", "pass")
+    elapsed = _median_ms("-m", module, "--list")
+    assert elapsed - baseline < STARTUP_BUDGET_MS, (
+        f"{module} --list took {elapsed:.0f} ms ({baseline:.0f} ms bare interpreter)"
+    )
+
+
+def test_settings_are_typed_and_absolute():
+    settings = get_settings()
+    assert isinstance(settings.download_timeout_seconds, float)
+    assert isinstance(settings.download_max_retries, int)
+    assert settings.data_raw_dir.is_absolute()
+    assert settings.duckdb_path.is_absolute()
+
+
+def test_settings_are_parsed_once(monkeypatch):
+    monkeypatch.setenv("DOWNLOAD_MAX_RETRIES", "7")
+    get_settings.cache_clear()
+    try:
+        first = get_settings()
+        monkeypatch.setenv("DOWNLOAD_MAX_RETRIES", "9")
+        assert get_settings() is first
+        assert first.download_max_retries == 7
+        assert Settings.from_env().download_max_retries == 9
+    finally:
+        get_settings.cache_clear()
+    assert load_env.cache_info().currsize == 1